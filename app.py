@@ -1,13 +1,51 @@
 from fastapi import FastAPI
 
-from routers import requests, auth, employee
+from config import Config
+from routers import requests, auth, employee, metrics, debug
+from utils.auth import password_pool
+from utils.db import close_clients, db_async, get_motor_client
+from utils.deadlines import deadline_timer
+from utils.indexes import ensure_indexes_async
+from utils.metrics import MetricsMiddleware
+from utils.profiler import ProfilerMiddleware
+from utils.tracing import TracingMiddleware
+from utils.request_cache import request_cache
 
-app = FastAPI(title="Realty-Service",
-              description="This is a training project, with auto docs for the API",
-              version="0.1",)
 
-app.include_router(requests.router, prefix='/requests')
-app.include_router(auth.router)
-app.include_router(employee.router, prefix='/employee')
+async def open_resources():
+    get_motor_client()  # Created on the event loop of the server
+    if Config.CREATE_INDEXES:
+        await ensure_indexes_async(db_async)
 
 
+async def close_resources():
+    await request_cache.close()
+    await deadline_timer.close()
+    password_pool.shutdown()
+    close_clients()
+
+
+def create_app() -> FastAPI:
+    """Create the application, its resources are opened on startup and closed on shutdown
+
+    :return: FastAPI application
+    """
+    application = FastAPI(title="Realty-Service",
+                          description="This is a training project, with auto docs for the API",
+                          version="0.1",)
+
+    application.include_router(requests.router, prefix='/requests')
+    application.include_router(auth.router)
+    application.include_router(employee.router, prefix='/employee')
+    application.include_router(metrics.router)
+    application.include_router(debug.router, prefix='/debug')
+    application.add_middleware(ProfilerMiddleware, routes=application.routes)
+    application.add_middleware(MetricsMiddleware, routes=application.routes)
+    application.add_middleware(TracingMiddleware, routes=application.routes)
+
+    application.add_event_handler('startup', open_resources)
+    application.add_event_handler('shutdown', close_resources)
+    return application
+
+
+app = create_app()
@@ -0,0 +1,101 @@
+"""Micro-benchmarks of the data layer, run with pytest-benchmark against the MongoDB of config.Config
+
+    pytest benchmarks/bench_db.py benchmarks/bench_models.py --benchmark-autosave
+    pytest benchmarks/bench_db.py benchmarks/bench_models.py --benchmark-compare --benchmark-compare-fail=median:10%
+
+The runs are saved in .benchmarks/, --benchmark-compare compares with the last saved run
+(or a given one, e.g. --benchmark-compare=0001). The seeded documents are removed at the end.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from config import Config
+from db import requests
+from db.user import get_user
+from models.user import UserInDB
+from utils.auth import create_access_token, get_current_user, get_password_hash
+from utils.cache import user_cache
+from utils.db import user_collection, request_collection
+from tests.utils import run
+
+EMAIL_DOMAIN = 'bench.realty.ru'
+COLLECTION_SIZES = [100, 1000, 10000]
+
+
+@pytest.fixture(scope='module')
+def accounts():
+    hash_password = get_password_hash('password')
+    users = {role: {'_id': ObjectId(), 'email': f'{role}@{EMAIL_DOMAIN}', 'hash_password': hash_password,
+                    'role': role, 'date_registration': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+             for role in ('user', 'employee', 'admin')}
+    user_collection.insert_many(list(users.values()))
+    yield {role: UserInDB(**user) for role, user in users.items()}
+    ids = [user['_id'] for user in users.values()]
+    request_collection.delete_many({'$or': [{'user_id': {'$in': ids}}, {'employee_id': {'$in': ids}}]})
+    user_collection.delete_many({'_id': {'$in': ids}})
+
+
+@pytest.fixture(scope='module', params=COLLECTION_SIZES)
+def collection_size(request, accounts):
+    """Fill the collection with requests of the user up to the size, the sizes are used in ascending order"""
+    size = request.param
+    existing = request_collection.count_documents({'user_id': accounts['user']._id})
+    now = datetime.now()
+    documents = [{'user_id': accounts['user']._id, 'employee_id': accounts['employee']._id, 'version': 1,
+                  'title': f'Title {i}', 'description': 'Description request ' * 10, 'status': 'active',
+                  'date_receipt': now - timedelta(minutes=i)} for i in range(existing, size)]
+    if documents:
+        request_collection.insert_many(documents)
+    return size
+
+
+@pytest.fixture(scope='module')
+def request_id(accounts):
+    return str(request_collection.insert_one({
+        'user_id': accounts['user']._id, 'employee_id': accounts['employee']._id, 'version': 1,
+        'title': 'Title', 'description': 'Description request', 'status': 'active',
+        'date_receipt': datetime.now()}).inserted_id)
+
+
+@pytest.mark.parametrize('limit', [Config.REQUESTS_PAGE_SIZE, None], ids=['page', 'all'])
+@pytest.mark.parametrize('role', ['user', 'admin'])
+def test_get_requests(benchmark, accounts, collection_size, role, limit):
+    benchmark.extra_info['collection_size'] = collection_size
+    assert benchmark(lambda: run(requests.get_requests(accounts[role], limit)))
+
+
+def test_get_requests_compact(benchmark, accounts, collection_size):
+    fields = requests.select_fields('user', compact=True)
+    benchmark.extra_info['collection_size'] = collection_size
+    assert benchmark(lambda: run(requests.get_requests(accounts['user'], Config.REQUESTS_PAGE_SIZE, fields=fields)))
+
+
+@pytest.mark.parametrize('role', ['user', 'employee', 'admin'])
+def test_get_request(benchmark, accounts, request_id, role):
+    result = benchmark(lambda: run(requests.get_request(request_id, accounts[role])))
+    assert result.request_id == request_id
+
+
+def test_edit_status_request(benchmark, accounts, request_id):
+    def reset():
+        request_collection.update_one({'_id': ObjectId(request_id)}, {'$set': {'status': 'active'}})
+
+    result = benchmark.pedantic(lambda: run(requests.edit_status_request(request_id, accounts['employee'])),
+                                setup=reset, rounds=200)
+    assert result.status == 'in_progress'
+
+
+def test_get_user(benchmark, accounts):
+    assert benchmark(lambda: run(get_user(accounts['user'].email))).email == accounts['user'].email
+
+
+def test_get_current_user(benchmark, accounts):
+    token = create_access_token(data={'sub': accounts['user'].email})
+    assert benchmark.pedantic(lambda: run(get_current_user(token)), setup=user_cache.clear, rounds=200)
+
+
+def test_get_current_user_cached(benchmark, accounts):
+    token = create_access_token(data={'sub': accounts['user'].email})
+    assert benchmark(lambda: run(get_current_user(token))).email == accounts['user'].email
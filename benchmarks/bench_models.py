@@ -0,0 +1,56 @@
+"""Micro-benchmarks of the conversions of MongoDB documents to the models, see bench_db.py for the usage"""
+from datetime import datetime
+
+import mock
+import pytest
+from bson import ObjectId
+
+from config import Config
+from db import requests
+from models.user import UserInDB, UserOut
+from utils.responses import build_model
+
+DOCUMENT = {'_id': ObjectId(), 'user_id': ObjectId(), 'employee_id': ObjectId(), 'version': 1,
+            'title': 'Title', 'description': 'Description request ' * 10, 'status': 'active',
+            'date_receipt': datetime(2020, 3, 29, 14, 10)}
+USER = {'_id': ObjectId(), 'email': 'user@bench.realty.ru', 'hash_password': 'hash', 'role': 'user',
+        'date_registration': '2020-03-29 14:10:00'}
+
+
+@pytest.fixture(params=[False, True], ids=['validated', 'fast'])
+def fast_responses(request):
+    with mock.patch.object(Config, 'FAST_RESPONSES', request.param):
+        yield request.param
+
+
+@pytest.mark.parametrize('role', ['user', 'employee', 'admin'])
+def test_request_out(benchmark, fast_responses, role):
+    assert benchmark(requests.request_out, DOCUMENT, role).request_id == str(DOCUMENT['_id'])
+
+
+def test_request_out_fields(benchmark, fast_responses):
+    fields = requests.select_fields('admin', ['title', 'status'])
+    assert benchmark(requests.request_out, DOCUMENT, 'admin', fields).title == DOCUMENT['title']
+
+
+def test_request_out_page(benchmark, fast_responses):
+    documents = [dict(DOCUMENT, _id=ObjectId()) for _ in range(100)]
+    assert len(benchmark(lambda: [requests.request_out(document, 'admin') for document in documents])) == 100
+
+
+def test_user_in_db(benchmark):
+    assert benchmark(lambda: UserInDB(**USER)).email == USER['email']
+
+
+def test_user_out(benchmark, fast_responses):
+    values = {'user_id': str(USER['_id']), 'email': USER['email'], 'role': USER['role'],
+              'date_registration': USER['date_registration']}
+    assert benchmark(build_model, UserOut, values).email == USER['email']
+
+
+@pytest.mark.parametrize('role', ['user', 'employee', 'admin'])
+def test_fast_matches_validated(role):
+    # The fast cases measure the same models as the validated ones
+    with mock.patch.object(Config, 'FAST_RESPONSES', True):
+        fast = requests.request_out(DOCUMENT, role)
+    assert fast.dict() == requests.request_out(DOCUMENT, role).dict()
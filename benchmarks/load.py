@@ -0,0 +1,397 @@
+"""Load test of the API with throughput and latency percentiles per endpoint
+
+Seeds users, employees and requests, drives concurrent virtual users through a weighted mix
+of operations and reports requests per second and p50/p95/p99 latency of every endpoint.
+The seeded data is written with the settings of config.Config, point DATABASE to a scratch database:
+
+    DATABASE=realty-load python -m benchmarks.load --concurrency 50 --duration 60
+    python -m benchmarks.load --url http://localhost:8000 --mix login=1,list=10,get=10,status=2,assign=1
+
+Without --url the application runs in-process on the event loop of the harness, so only MongoDB
+(and Redis when REQUEST_CACHE is enabled) must be running.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+# Seeded accounts are recognised by the domain of their email
+EMAIL_DOMAIN = 'load.realty.ru'
+PASSWORD = 'load-password'
+STATUSES = [('draft', 10), ('active', 40), ('in_progress', 30), ('finished', 20)]
+DEFAULT_MIX = 'login=1,list=10,get=10,status=2,assign=1'
+
+
+class Fixtures:
+    """Seeded accounts with their tokens and request ids"""
+
+    def __init__(self):
+        self.users = []  # [{'email', 'token', 'requests'}]
+        self.employees = []  # [{'_id', 'email', 'token', 'requests'}]
+        self.admin = None
+        self.active = []  # ids of the requests in the active status
+
+
+def seed(users: int, employees: int, requests_per_user: int, rng: random.Random) -> Fixtures:
+    """Write the accounts and the requests of the load test to MongoDB
+
+    :param users: number of users
+    :param employees: number of employees
+    :param requests_per_user: number of requests of every user
+    :param rng: random generator
+    :return: Fixtures without tokens
+    """
+    from utils.auth import get_password_hash
+    from utils.db import user_collection, request_collection
+
+    cleanup()
+    hash_password = get_password_hash(PASSWORD)
+    now = datetime.now()
+
+    def account(role: str, number: int) -> dict:
+        return {'_id': ObjectId(), 'email': f'{role}-{number}@{EMAIL_DOMAIN}', 'hash_password': hash_password,
+                'role': role, 'date_registration': now.strftime("%Y-%m-%d %H:%M:%S")}
+
+    accounts = ([account('admin', 0)] + [account('employee', i) for i in range(employees)] +
+                [account('user', i) for i in range(users)])
+    user_collection.insert_many(accounts)
+
+    fixtures = Fixtures()
+    fixtures.admin = {'email': accounts[0]['email'], 'token': None}
+    fixtures.employees = [{'_id': str(a['_id']), 'email': a['email'], 'token': None, 'requests': []}
+                          for a in accounts if a['role'] == 'employee']
+    statuses, weights = zip(*STATUSES)
+    documents = []
+    for a in accounts[1 + employees:]:
+        user = {'email': a['email'], 'token': None, 'requests': []}
+        for _ in range(requests_per_user):
+            request_status = rng.choices(statuses, weights)[0]
+            employee = rng.choice(fixtures.employees) if fixtures.employees else None
+            assigned = employee and (request_status in ('in_progress', 'finished') or rng.random() < 0.5)
+            document = {'_id': ObjectId(), 'user_id': a['_id'], 'employee_id': '', 'version': 1,
+                        'title': f'Request of {a["email"]} #{len(user["requests"])}',
+                        'description': 'Description of the request ' * rng.randint(1, 20),
+                        'date_receipt': now - timedelta(minutes=rng.randint(0, 90 * 24 * 60)),
+                        'status': request_status}
+            if request_status != 'draft':
+                user['requests'].append(str(document['_id']))
+            if assigned and request_status != 'draft':
+                document['employee_id'] = ObjectId(employee['_id'])
+                employee['requests'].append(str(document['_id']))
+            if request_status == 'active':
+                fixtures.active.append(str(document['_id']))
+            documents.append(document)
+        fixtures.users.append(user)
+    for start in range(0, len(documents), 1000):
+        request_collection.insert_many(documents[start:start + 1000])
+    return fixtures
+
+
+def cleanup():
+    """Delete the accounts and the requests seeded by the load test"""
+    from utils.db import user_collection, request_collection
+
+    query = {'email': {'$regex': f'@{EMAIL_DOMAIN.replace(".", "[.]")}$'}}
+    ids = [user['_id'] for user in user_collection.find(query, {'_id': 1})]
+    request_collection.delete_many({'user_id': {'$in': ids}})
+    user_collection.delete_many(query)
+
+
+class HTTPTransport:
+    """Sends the requests to a running server, one keep-alive session per thread"""
+
+    def __init__(self, url: str, concurrency: int):
+        import requests
+        self._session_class = requests.Session
+        self.url = url.rstrip('/')
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._local = threading.local()
+
+    def _send(self, method: str, path: str, headers: dict, body) -> tuple:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._session_class()
+        response = session.request(method, self.url + path, headers=headers, json=body)
+        return response.status_code, response.content
+
+    async def request(self, method: str, path: str, headers: dict = None, body=None) -> tuple:
+        """Send a request
+
+        :return: tuple (status code, body)
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self._send, method, path,
+                                                              headers or {}, body)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        self._executor.shutdown()
+
+
+class ASGITransport:
+    """Calls the ASGI application in-process, on the event loop of the harness"""
+
+    def __init__(self):
+        from app import app
+        self.app = app
+
+    async def request(self, method: str, path: str, headers: dict = None, body=None) -> tuple:
+        """Send a request
+
+        :return: tuple (status code, body)
+        """
+        path, _, query = path.partition('?')
+        content = json.dumps(body).encode() if body is not None else b''
+        raw_headers = [(b'host', b'load'), (b'content-length', str(len(content)).encode())]
+        if body is not None:
+            raw_headers.append((b'content-type', b'application/json'))
+        raw_headers += [(key.lower().encode(), str(value).encode()) for key, value in (headers or {}).items()]
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+                 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+                 'headers': raw_headers, 'server': ('load', 80), 'client': ('127.0.0.1', 0)}
+        messages = [{'type': 'http.request', 'body': content, 'more_body': False}]
+        response = {'status': 0, 'body': []}
+
+        async def receive():
+            return messages.pop() if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        return response['status'], b''.join(response['body'])
+
+    async def start(self):
+        await self.app.router.startup()
+
+    async def close(self):
+        await self.app.router.shutdown()
+
+
+def login_operation(fixtures: Fixtures, rng: random.Random) -> tuple:
+    account = rng.choice(fixtures.users)
+    return 'POST /login', 'POST', '/login', {}, {'email': account['email'], 'password': PASSWORD}
+
+
+def list_operation(fixtures: Fixtures, rng: random.Random) -> tuple:
+    account = rng.choice(fixtures.users)
+    return 'GET /requests', 'GET', '/requests', {'jwt': account['token']}, None
+
+
+def get_operation(fixtures: Fixtures, rng: random.Random) -> tuple:
+    account = rng.choice([user for user in fixtures.users if user['requests']] or fixtures.users)
+    request_id = rng.choice(account['requests'] or [str(ObjectId())])
+    return 'GET /requests/{id}', 'GET', f'/requests/{request_id}', {'jwt': account['token']}, None
+
+
+def status_operation(fixtures: Fixtures, rng: random.Random) -> tuple:
+    account = rng.choice([employee for employee in fixtures.employees if employee['requests']] or
+                         fixtures.employees)
+    request_id = rng.choice(account['requests'] or [str(ObjectId())])
+    return ('PATCH /requests/status/{id}', 'PATCH', f'/requests/status/{request_id}',
+            {'jwt': account['token']}, None)
+
+
+def assign_operation(fixtures: Fixtures, rng: random.Random) -> tuple:
+    employee = rng.choice(fixtures.employees)
+    request_id = rng.choice(fixtures.active or [str(ObjectId())])
+    return ('PATCH /employee/assign', 'PATCH', f'/employee/assign?employee_id={employee["_id"]}'
+                                               f'&request_id={request_id}',
+            {'jwt': fixtures.admin['token']}, None)
+
+
+OPERATIONS = {'login': login_operation, 'list': list_operation, 'get': get_operation,
+              'status': status_operation, 'assign': assign_operation}
+
+
+def parse_mix(mix: str) -> dict:
+    """Parse the weights of the operations
+
+    :param mix: string as login=1,list=10
+    :return: dictionary {operation: weight}
+    """
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise ValueError(f'Unknown operation {name!r}, expected one of {", ".join(OPERATIONS)}')
+        try:
+            weights[name.strip()] = float(weight or 1)
+        except ValueError:
+            raise ValueError(f'Invalid weight {weight!r} of {name.strip()}') from None
+        if not 0 <= weights[name.strip()] < float('inf'):
+            raise ValueError(f'Invalid weight {weight!r} of {name.strip()}')
+    if not any(weights.values()):
+        raise ValueError('At least one operation must have a positive weight')
+    return weights
+
+
+class Recorder:
+    """Latencies and status codes of the responses by endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, endpoint: str, seconds: float, status_code: int):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status_code] += 1
+
+
+def percentile(samples: list, q: float) -> float:
+    """Nearest-rank percentile
+
+    :param samples: sorted values
+    :param q: percentile from 0 to 100
+    :return: value or 0 for no samples
+    """
+    if not 0 <= q <= 100:
+        raise ValueError(f'Invalid percentile {q}')
+    if not samples:
+        return 0.0
+    rank = max(1, int(-(-q * len(samples) // 100)))
+    return samples[rank - 1]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> list:
+    """Compute the statistics of every endpoint
+
+    :param recorder: Recorder of the run
+    :param elapsed: duration of the measured part of the run, in seconds
+    :return: list of dictionaries, milliseconds for the latencies
+    """
+    rows = []
+    for endpoint in sorted(recorder.latencies):
+        samples = sorted(recorder.latencies[endpoint])
+        statuses = recorder.statuses[endpoint]
+        rows.append({
+            'endpoint': endpoint,
+            'count': len(samples),
+            'rps': len(samples) / elapsed if elapsed else 0.0,
+            'rejected': sum(count for code, count in statuses.items() if 400 <= code < 500),
+            'errors': sum(count for code, count in statuses.items() if code >= 500 or code == 0),
+            'p50': percentile(samples, 50) * 1000,
+            'p95': percentile(samples, 95) * 1000,
+            'p99': percentile(samples, 99) * 1000,
+            'max': samples[-1] * 1000,
+        })
+    return rows
+
+
+def print_report(rows: list, elapsed: float):
+    print(f'{"endpoint":<30}{"count":>8}{"rps":>9}{"4xx":>7}{"errors":>8}'
+          f'{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+    for row in rows:
+        print(f'{row["endpoint"]:<30}{row["count"]:>8}{row["rps"]:>9.1f}{row["rejected"]:>7}{row["errors"]:>8}'
+              f'{row["p50"]:>9.1f}{row["p95"]:>9.1f}{row["p99"]:>9.1f}{row["max"]:>9.1f}')
+    total = sum(row['count'] for row in rows)
+    print(f'{total} requests in {elapsed:.1f} s, {total / elapsed if elapsed else 0:.1f} requests/s')
+
+
+async def authenticate(transport, fixtures: Fixtures):
+    """Get the tokens of the seeded accounts"""
+    async def token(account: dict):
+        status_code, body = await transport.request('POST', '/login', body={'email': account['email'],
+                                                                           'password': PASSWORD})
+        if status_code != 200:
+            raise RuntimeError(f'Login of {account["email"]} failed with {status_code}: {body[:200]}')
+        account['token'] = json.loads(body)['access_token']
+
+    await asyncio.gather(*(token(account) for account in [fixtures.admin] + fixtures.employees + fixtures.users))
+
+
+async def virtual_user(transport, fixtures: Fixtures, weights: dict, recorder: Recorder, warmup_until: float,
+                       deadline: float, rng: random.Random):
+    names, values = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        endpoint, method, path, headers, body = OPERATIONS[rng.choices(names, values)[0]](fixtures, rng)
+        started = time.perf_counter()
+        try:
+            status_code, _ = await transport.request(method, path, headers, body)
+        except Exception as e:  # The error is reported in the statistics of the endpoint
+            print(f'Error: {endpoint}: {e}')
+            status_code = 0
+        if started >= warmup_until:
+            recorder.record(endpoint, time.perf_counter() - started, status_code)
+
+
+async def run_load(transport, fixtures: Fixtures, weights: dict, concurrency: int, duration: float,
+                   warmup: float, seed_value: int = None) -> tuple:
+    """Drive the virtual users
+
+    :return: tuple (Recorder, measured duration in seconds)
+    """
+    recorder = Recorder()
+    warmup_until = time.perf_counter() + warmup
+    deadline = warmup_until + duration
+    await asyncio.gather(*(virtual_user(transport, fixtures, weights, recorder, warmup_until, deadline,
+                                        random.Random(None if seed_value is None else seed_value + number))
+                           for number in range(concurrency)))
+    return recorder, time.perf_counter() - warmup_until
+
+
+async def main_async(args) -> int:
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    print(f'Seeding {args.users} users, {args.employees} employees, '
+          f'{args.users * args.requests_per_user} requests')
+    fixtures = seed(args.users, args.employees, args.requests_per_user, rng)
+    transport = HTTPTransport(args.url, args.concurrency) if args.url else ASGITransport()
+    try:
+        await transport.start()
+        await authenticate(transport, fixtures)
+        print(f'Running {args.concurrency} virtual users for {args.duration} s '
+              f'after a warm-up of {args.warmup} s ({args.url or "in-process"})')
+        recorder, elapsed = await run_load(transport, fixtures, weights, args.concurrency, args.duration,
+                                           args.warmup, args.seed)
+    finally:
+        await transport.close()
+        if not args.keep:
+            cleanup()
+    rows = summarize(recorder, elapsed)
+    print_report(rows, elapsed)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'concurrency': args.concurrency, 'duration': elapsed, 'mix': weights,
+                       'url': args.url, 'endpoints': rows}, file, indent=2)
+    slow = [row['endpoint'] for row in rows if args.max_p95 and row['p95'] > args.max_p95]
+    failed = [row['endpoint'] for row in rows if row['errors']]
+    for endpoint in slow:
+        print(f'{endpoint}: p95 is above {args.max_p95} ms')
+    for endpoint in failed:
+        print(f'{endpoint}: server errors')
+    return 1 if slow or failed else 0
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='base url of a running server, the app runs in-process without it')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before the measurement')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the operations')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--employees', type=int, default=10)
+    parser.add_argument('--requests-per-user', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generators')
+    parser.add_argument('--json', help='write the statistics to this file')
+    parser.add_argument('--max-p95', type=float, default=None, help='fail if the p95 of an endpoint is above (ms)')
+    parser.add_argument('--keep', action='store_true', help='keep the seeded data')
+    args = parser.parse_args(argv)
+    return asyncio.get_event_loop().run_until_complete(main_async(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
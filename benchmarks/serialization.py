@@ -0,0 +1,55 @@
+"""Per-row cost of building and serializing the GET /requests response
+
+Compares the default path (validated models, jsonable_encoder, json)
+with the fast path of FAST_RESPONSES (trusted construction, orjson):
+
+    python -m benchmarks.serialization --rows 1000 --repeat 20
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from models.requests import RequestOutAdmin
+from utils.responses import ORJSONResponse
+
+
+def make_rows(count: int) -> list:
+    """Values of RequestOutAdmin as request_out gets them from MongoDB documents"""
+    return [{'request_id': str(ObjectId()), 'title': f'Title {i}', 'description': 'Description request ' * 10,
+             'status': 'active', 'date_receipt': datetime(2020, 3, 29, 14, 10), 'user_id': str(ObjectId()),
+             'employee_id': ''} for i in range(count)]
+
+
+def default_path(rows: list) -> bytes:
+    requests = [RequestOutAdmin(**row) for row in rows]
+    return JSONResponse(jsonable_encoder({'requests': requests, 'next_cursor': None})).body
+
+
+def fast_path(rows: list) -> bytes:
+    requests = [RequestOutAdmin.construct(_fields_set=set(row), **row) for row in rows]
+    return ORJSONResponse({'requests': requests, 'next_cursor': None}).body
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.rows)
+    assert json.loads(default_path(rows[:1])) == json.loads(fast_path(rows[:1]))  # The order of the keys differs
+    results = {}
+    for name, function in (('default', default_path), ('fast', fast_path)):
+        best = min(timeit.repeat(lambda: function(rows), number=1, repeat=args.repeat))
+        results[name] = best / args.rows * 1e6
+        print(f'{name:>8}: {results[name]:8.2f} us/row')
+    print(f' speedup: {results["default"] / results["fast"]:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
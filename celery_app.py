@@ -1,29 +1,90 @@
-import smtplib
+import os
 from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from bson import ObjectId
 from celery import Celery
-from celery.schedules import crontab
+from celery.signals import (after_task_publish, before_task_publish, task_failure, task_postrun, task_prerun,
+                            worker_init, worker_process_shutdown)
+from prometheus_client import multiprocess, start_http_server
 
 from config import Config, ConfigCelery
-from utils.db import request_collection, user_collection
+from utils.db import request_collection, user_collection, notification_collection
+from utils.deadlines import CONSIDERATION, EXECUTION, consideration_deadline, deadline_timer, execution_deadline
+from utils.ledger import filter_not_notified, record_notified
+from utils import metrics, profiler, tracing
+from utils.smtp import SMTPPool
 
 celery = Celery('celery_app')
 celery.config_from_object(ConfigCelery)
 
+# Only the deadlines which have passed are read, see utils.deadlines
 celery.conf.beat_schedule = {
-    "overdue_requests_processing": {
-        "task": 'celery_app.warning_admin_long_time_consider_request',
-        'schedule': crontab(minute=Config.CHECK_OVERDUE_REQUEST_PERIOD)
+    "request_deadlines": {
+        "task": 'celery_app.fire_due_deadlines',
+        'schedule': Config.DEADLINE_TIMER_INTERVAL
     },
-    "overdue_requests_execution": {
-        "task": 'celery_app.warning_employee_long_time_complete_request',
-        'schedule': crontab(minute=Config.CHECK_OVERDUE_REQUEST_PERIOD)
+    "reconcile_deadlines": {
+        "task": 'celery_app.schedule_existing_deadlines',
+        'schedule': Config.DEADLINE_RECONCILE_INTERVAL
     }
 }
 
+# Authenticated connections reused between messages, one pool per worker process
+smtp_pool = SMTPPool(Config.SMTP_SERVER, Config.SMTP_PORT, Config.EMAIL, Config.EMAIL_PASSWORD,
+                     size=Config.SMTP_POOL_SIZE, max_messages=Config.SMTP_MAX_MESSAGES_PER_CONNECTION,
+                     healthcheck_interval=Config.SMTP_HEALTHCHECK_INTERVAL)
+
+
+@worker_process_shutdown.connect
+def close_smtp_pool(**kwargs):
+    smtp_pool.close()
+
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    # The worker processes share their metrics through prometheus_multiproc_dir, see utils.metrics
+    if Config.CELERY_METRICS_PORT:
+        start_http_server(Config.CELERY_METRICS_PORT, registry=metrics.metrics_registry())
+
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    if 'prometheus_multiproc_dir' in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+@before_task_publish.connect
+def before_publish(headers=None, **kwargs):
+    metrics.task_published(headers)
+    tracing.task_publishing(headers)
+
+
+@after_task_publish.connect
+def after_publish(headers=None, **kwargs):
+    tracing.task_published(headers)
+
+
+@task_prerun.connect
+def before_task(task_id=None, task=None, **kwargs):
+    tracing.task_started(task, task_id)
+    metrics.task_started(task, task_id)
+    profiler.task_started(task_id, task.name)
+
+
+@task_postrun.connect
+def after_task(task_id=None, task=None, state=None, **kwargs):
+    profiler.task_finished(task_id)
+    metrics.task_finished(task, task_id)
+    tracing.task_finished(task_id, state)
+
+
+@task_failure.connect
+def on_task_failure(sender=None, task_id=None, exception=None, **kwargs):
+    metrics.task_failed(sender.name)
+    tracing.task_failed(task_id, exception)
+
 
 @celery.task
 def send_email(email, title, description) -> bool:
@@ -35,9 +96,6 @@ def send_email(email, title, description) -> bool:
     :return: True if the email is sent, otherwise False
     """
     try:
-        smtpObj = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
-        smtpObj.starttls()
-        smtpObj.login(Config.EMAIL, Config.EMAIL_PASSWORD)
         message = MIMEMultipart("alternative")
         message["Subject"] = title
         message["From"] = Config.EMAIL
@@ -45,53 +103,191 @@ def send_email(email, title, description) -> bool:
         msg = f"""\
                 {description}"""
         message.attach(MIMEText(msg, 'plain'))
-        smtpObj.sendmail(Config.EMAIL, email, message.as_string())
+        smtp_pool.sendmail(Config.EMAIL, email, message.as_string())
     except Exception as error:  # If an exception is raised when send email
         print(error)
+        metrics.task_failed(send_email.name)
         return False
     return True
 
 
+def format_digest(text: str, requests: list) -> str:
+    """Build the text of a letter about several overdue requests
+
+    :param text: the first line of the letter
+    :param requests: overdue requests (dictionaries with _id and title)
+    :return: the text of the letter, at most NOTIFICATION_DIGEST_MAX_ITEMS requests are listed
+    """
+    lines = [f'{text} ({len(requests)}):']
+    lines += [f"{request['title']} id = {request['_id']}"
+              for request in requests[:Config.NOTIFICATION_DIGEST_MAX_ITEMS]]
+    if len(requests) > Config.NOTIFICATION_DIGEST_MAX_ITEMS:
+        lines.append(f'... and {len(requests) - Config.NOTIFICATION_DIGEST_MAX_ITEMS} more')
+    return '\n'.join(lines)
+
+
+def notify_overdue(overdue_requests: list, text: str):
+    """Send letters about overdue requests, one letter per recipient in the digest mode
+
+    :param overdue_requests: overdue requests (dictionaries with email of the recipient, _id and title)
+    :param text: description of the problem
+    """
+    if Config.NOTIFICATION_DIGEST:
+        requests_by_email = {}
+        for request in overdue_requests:
+            requests_by_email.setdefault(request['email'], []).append(request)
+        for email, requests in requests_by_email.items():
+            send_email.delay(email, f'Overdue requests ({len(requests)})', format_digest(text, requests))
+    else:
+        for request in overdue_requests:
+            send_email.delay(request['email'], 'Overdue request', f"{text}: {request['title']} id = {request['_id']}")
+
+
+def overdue_consideration(match: dict) -> list:
+    """Find the requests without an employee, with the email of the admin
+
+    :param match: filter of the requests
+    :return: list of dictionaries with _id, title and email
+    """
+    admin = user_collection.find_one({'role': 'admin'}, {'email': 1})
+    overdue_requests = list(request_collection.find(dict(match, employee_id=''), {'title': 1}))
+    for request in overdue_requests:
+        request['email'] = admin['email']
+    return overdue_requests
+
+
+def overdue_execution(match: dict) -> list:
+    """Find the unfinished requests with an employee, with the email of the employee
+
+    :param match: filter of the requests
+    :return: list of dictionaries with _id, title and email
+    """
+    return list(request_collection.aggregate([
+        {'$match': dict(match, employee_id={'$ne': ''}, status={'$ne': 'finished'})},
+        {'$lookup': {'from': user_collection.name, 'localField': 'employee_id', 'foreignField': '_id',
+                     'as': 'employee'}},
+        {'$unwind': '$employee'},
+        {'$project': {'title': 1, 'email': '$employee.email'}}
+    ]))
+
+
+# Query of the overdue requests, text of the letter and renotify interval in hours by alert
+ALERTS = {
+    CONSIDERATION: (overdue_consideration, lambda: "You're taking too long to process the request "
+                                                   f"(> {Config.CONSIDERATION_REQUEST_TIME} hours)",
+                    lambda: Config.RENOTIFY_CONSIDERATION_INTERVAL),
+    EXECUTION: (overdue_execution, lambda: "You take too long to complete the request "
+                                           f"(> {Config.REQUEST_EXECUTION_TIME} hours)",
+                lambda: Config.RENOTIFY_EXECUTION_INTERVAL),
+}
+
+
+def alert_overdue(alert: str, overdue_requests: list) -> list:
+    """Notify about overdue requests which weren't notified recently
+
+    :param alert: CONSIDERATION or EXECUTION
+    :param overdue_requests: list of dictionaries with _id, title and email
+    :return: the notified requests
+    """
+    _, text, renotify_interval = ALERTS[alert]
+    overdue_requests = filter_not_notified(notification_collection, alert, overdue_requests)
+    if overdue_requests:
+        notify_overdue(overdue_requests, text())
+        record_notified(notification_collection, alert, overdue_requests, renotify_interval())
+    return overdue_requests
+
+
+@celery.task
+def fire_due_deadlines() -> int:
+    """Send the alerts of the requests whose deadline has passed (see utils.deadlines)
+
+    The requests still overdue get a new deadline after the renotify interval of the alert.
+
+    :return: number of the claimed deadlines
+    """
+    due = {}
+    try:
+        due = deadline_timer.claim_due(Config.DEADLINE_BATCH_SIZE)
+        for alert, request_ids in due.items():
+            if alert not in ALERTS:
+                continue
+            find_overdue, _, renotify_interval = ALERTS[alert]
+            overdue_requests = find_overdue({'_id': {'$in': [ObjectId(request_id) for request_id in request_ids]}})
+            alert_overdue(alert, overdue_requests)
+            deadline_timer.schedule_sync(alert, [str(request['_id']) for request in overdue_requests],
+                                         datetime.now() + timedelta(hours=renotify_interval()))
+    except Exception as error:
+        print(f'Error: {error}')
+        metrics.task_failed(fire_due_deadlines.name)
+        try:  # The claimed deadlines are retried on the next run
+            for alert, request_ids in due.items():
+                deadline_timer.schedule_sync(alert, request_ids, datetime.now())
+        except Exception as error:
+            print(f'Error: {error}')
+        return 0
+    return sum(len(request_ids) for request_ids in due.values())
+
+
+@celery.task
+def schedule_existing_deadlines() -> int:
+    """Schedule the missing deadlines of the unfinished requests
+
+    Runs every DEADLINE_RECONCILE_INTERVAL seconds: the deadlines the API failed to schedule because of Redis and
+    the ones of the requests created before the deadline timer. The scheduled deadlines are not changed.
+
+    :return: number of the deadlines which were missing
+    """
+    try:
+        scheduled = 0
+        deadlines = {CONSIDERATION: {}, EXECUTION: {}}
+        for request in request_collection.find({'status': {'$ne': 'finished'}},
+                                               {'employee_id': 1, 'date_receipt': 1}):
+            if request['employee_id']:
+                deadlines[EXECUTION][str(request['_id'])] = execution_deadline(request['date_receipt'])
+            else:
+                deadlines[CONSIDERATION][str(request['_id'])] = consideration_deadline(request['date_receipt'])
+            if sum(map(len, deadlines.values())) >= Config.DEADLINE_BATCH_SIZE:
+                scheduled += sum(deadline_timer.reconcile(alert, batch) for alert, batch in deadlines.items())
+                deadlines = {CONSIDERATION: {}, EXECUTION: {}}
+        scheduled += sum(deadline_timer.reconcile(alert, batch) for alert, batch in deadlines.items())
+    except Exception as error:
+        print(f'Error: {error}')
+        metrics.task_failed(schedule_existing_deadlines.name)
+        return 0
+    if scheduled:
+        profiler.log('deadlines_reconciled', scheduled=scheduled)
+    return scheduled
+
+
 @celery.task
 def warning_admin_long_time_consider_request():
-    admin = user_collection.find_one({'role': 'admin'})
+    """Full scan for the requests waiting too long for an employee, not scheduled, fire_due_deadlines sends the alerts
+
+    :return: True if some requests are notified
+    """
     try:
-        requests = request_collection.find({'employee_id': ''})
-        now = datetime.now()
-        overdue_requests = [request for request in requests
-                            if (now - request['date_receipt']) > timedelta(
-                                hours=Config.CONSIDERATION_REQUEST_TIME)]
-        if not overdue_requests:
+        threshold = datetime.now() - timedelta(hours=Config.CONSIDERATION_REQUEST_TIME)
+        if not alert_overdue(CONSIDERATION, overdue_consideration({'date_receipt': {'$lt': threshold}})):
             return False
-        for request in overdue_requests:
-            send_email.delay(admin['email'], 'Overdue request', "You're taking too long to process the request "
-                                                                f"(> {Config.CONSIDERATION_REQUEST_TIME} hours): "
-                                                                f"{request['title']} id = {request['_id']}")
     except Exception as error:
         print(f'Error: {error}')
+        metrics.task_failed(warning_admin_long_time_consider_request.name)
         return False
     return True
 
 
 @celery.task
 def warning_employee_long_time_complete_request():
+    """Full scan for the requests in progress for too long, not scheduled, fire_due_deadlines sends the alerts
+
+    :return: True if some requests are notified
+    """
     try:
-        requests = request_collection.find({'$and': [
-            {'employee_id': {'$not': {'$eq': ''}}},
-            {'status': {'$not': {'$eq': 'finished'}}}
-        ]})
-        now = datetime.now()
-        overdue_requests = [request for request in requests
-                            if (now - request['date_receipt']) > timedelta(
-                                hours=Config.REQUEST_EXECUTION_TIME)]
-        if not overdue_requests:
+        threshold = datetime.now() - timedelta(hours=Config.REQUEST_EXECUTION_TIME)
+        if not alert_overdue(EXECUTION, overdue_execution({'date_receipt': {'$lt': threshold}})):
             return False
-        for request in overdue_requests:
-            employee_email = user_collection.find_one({'_id': ObjectId(request['employee_id'])})['email']
-            send_email.delay(employee_email, 'Overdue request', "You take too long to complete the request "
-                                                                f"(> {Config.REQUEST_EXECUTION_TIME} hours): "
-                                                                f"{request['title']} id = {request['_id']}")
     except Exception as error:
         print(f'Error: {error}')
+        metrics.task_failed(warning_employee_long_time_complete_request.name)
         return False
-    return True
\ No newline at end of file
+    return True
@@ -11,11 +11,45 @@ class Config(object):
     SMTP_PORT = os.environ.get('SMTP_PORT', 587)
     EMAIL = os.environ.get('EMAIL', 'bykov@appvelox.ru')
     EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '9Fhc7RnZ1kMV')
+    SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 2))
+    SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+    SMTP_HEALTHCHECK_INTERVAL = float(os.environ.get('SMTP_HEALTHCHECK_INTERVAL', 30))
+    NOTIFICATION_DIGEST = os.environ.get('NOTIFICATION_DIGEST', 'false').lower() == 'true'
+    NOTIFICATION_DIGEST_MAX_ITEMS = int(os.environ.get('NOTIFICATION_DIGEST_MAX_ITEMS', 50))
+    RENOTIFY_CONSIDERATION_INTERVAL = float(os.environ.get('RENOTIFY_CONSIDERATION_INTERVAL', 24))
+    RENOTIFY_EXECUTION_INTERVAL = float(os.environ.get('RENOTIFY_EXECUTION_INTERVAL', 24))
     ALGORITHM = os.environ.get('ALGORITHM', "HS256")
     ACCESS_TOKEN_EXPIRE_MINUTES = os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', 30)
-    CHECK_OVERDUE_REQUEST_PERIOD = os.environ.get('CHECK_OVERDUE_REQUEST_PERIOD', 15)
     CONSIDERATION_REQUEST_TIME = os.environ.get('CONSIDERATION_REQUEST_TIME', 5)
     REQUEST_EXECUTION_TIME = os.environ.get('REQUEST_EXECUTION_TIME', 72)
+    REQUESTS_PAGE_SIZE = int(os.environ.get('REQUESTS_PAGE_SIZE', 50))
+    REQUESTS_MAX_PAGE_SIZE = int(os.environ.get('REQUESTS_MAX_PAGE_SIZE', 500))
+    BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 1000))
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+    AUTH_TOKEN_CLAIMS = os.environ.get('AUTH_TOKEN_CLAIMS', 'false').lower() == 'true'
+    TOKEN_VERSION_CACHE_TTL = float(os.environ.get('TOKEN_VERSION_CACHE_TTL', 5))
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64))
+    FAST_RESPONSES = os.environ.get('FAST_RESPONSES', 'false').lower() == 'true'
+    REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+    REQUEST_CACHE = os.environ.get('REQUEST_CACHE', 'false').lower() == 'true'
+    REQUEST_CACHE_TTL = int(os.environ.get('REQUEST_CACHE_TTL', 300))
+    PROFILER = os.environ.get('PROFILER', 'false').lower() == 'true'
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+    QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 10))
+    PROFILER_HISTORY = int(os.environ.get('PROFILER_HISTORY', 100))
+    TRACING = os.environ.get('TRACING', 'false').lower() == 'true'
+    TRACING_SERVICE_NAME = os.environ.get('TRACING_SERVICE_NAME', 'realty-service')
+    TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'file')
+    TRACING_FILE = os.environ.get('TRACING_FILE', 'traces.jsonl')
+    TRACING_OTLP_URL = os.environ.get('TRACING_OTLP_URL', 'http://localhost:4318/v1/traces')
+    DEADLINE_TIMER_INTERVAL = float(os.environ.get('DEADLINE_TIMER_INTERVAL', 30))
+    DEADLINE_BATCH_SIZE = int(os.environ.get('DEADLINE_BATCH_SIZE', 1000))
+    DEADLINE_RECONCILE_INTERVAL = float(os.environ.get('DEADLINE_RECONCILE_INTERVAL', 24 * 60 * 60))
+    CELERY_METRICS_PORT = int(os.environ.get('CELERY_METRICS_PORT', 0))
+    CREATE_INDEXES = os.environ.get('CREATE_INDEXES', 'true').lower() == 'true'
 
 
 class ConfigCelery:
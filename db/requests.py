@@ -1,15 +1,132 @@
+import asyncio
+from collections import Counter
 from typing import Union
 
 from bson.objectid import ObjectId
 from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
 from starlette import status
 
-from models.requests import RequestIn, RequestOut, RequestOutEmployee, RequestOutAdmin
+from config import Config
+from models.requests import (RequestIn, RequestOut, RequestOutAdmin, BulkItemResult,
+                             RESPONSE_MODELS, partial_model)
 from models.user import UserInDB
-from utils.db import request_collection
+from utils.db import request_collection_async as request_collection, user_collection_async as user_collection
+from utils.deadlines import CONSIDERATION, EXECUTION, consideration_deadline, deadline_timer, execution_deadline
+from utils.pagination import SORT_REQUESTS, keyset_filter
+from utils.request_cache import request_cache
+from utils.responses import build_model
 
 
-def create_request(request: RequestIn, user_id: ObjectId) -> RequestOut:
+# The next status of a request by the role of the user changing it
+STATUS_TRANSITIONS = {
+    'user': {'draft': 'active'},
+    'employee': {'active': 'in_progress', 'in_progress': 'finished'},
+    'admin': {'active': 'in_progress', 'in_progress': 'finished'},
+}
+
+
+# The fields of a document by the fields of the response models
+DOCUMENT_FIELDS = {'request_id': '_id', 'user_id': 'user_id', 'employee_id': 'employee_id', 'title': 'title',
+                   'description': 'description', 'status': 'status', 'date_receipt': 'date_receipt'}
+# The fields returned in any sparse fieldset, the cursor of the pages is built from them
+REQUIRED_FIELDS = frozenset({'request_id', 'date_receipt'})
+
+
+def select_fields(role: str, fields: list = None, compact: bool = False):
+    """Validate a sparse fieldset
+
+    :param role: role of the user (user/employee/admin)
+    :param fields: names of the requested fields, all fields if None
+    :param compact: all fields except the description
+    :return: frozenset of the fields or None for all fields
+    """
+    if role not in RESPONSE_MODELS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid user')
+    available = RESPONSE_MODELS[role].__fields__
+    if not fields:
+        return frozenset(available) - {'description'} if compact else None
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Unknown fields: {", ".join(unknown)}')
+    return REQUIRED_FIELDS | frozenset(fields)
+
+
+def projection(fields: frozenset = None):
+    """Get the MongoDB projection of a sparse fieldset
+
+    :param fields: fields from select_fields
+    :return: projection or None for whole documents
+    """
+    if fields is None:
+        return None
+    return dict({DOCUMENT_FIELDS[field]: 1 for field in fields}, version=1)
+
+
+def request_out(request: dict, role: str, fields: frozenset = None) -> RequestOut:
+    """Build the response model of a request for the role of the user
+
+    :param request: document of the request
+    :param role: role of the user (user/employee/admin)
+    :param fields: sparse fieldset from select_fields, all fields if None
+    :return: RequestOut/RequestOutEmployee/RequestOutAdmin or the partial model of the fieldset
+    """
+    model = RESPONSE_MODELS[role] if fields is None else partial_model(role, fields)
+    data = {field: request[DOCUMENT_FIELDS[field]] for field in model.__fields__}
+    for field in ('request_id', 'user_id', 'employee_id'):
+        if field in data:
+            data[field] = str(data[field])
+    return build_model(model, data)
+
+
+def can_read(request: dict, user_data: UserInDB) -> bool:
+    """Check that the user may read the request, the same rules as the queries of get_request
+
+    :param request: document of the request
+    :param user_data: object UserInDB
+    :return: True if the request is visible to the user
+    """
+    if user_data.role == 'user':
+        return request['user_id'] == user_data._id
+    elif user_data.role == 'employee':
+        return request['employee_id'] == user_data._id
+    elif user_data.role == 'admin':
+        return request['status'] != 'draft'
+    return False
+
+
+async def cache_requests(*requests):
+    """Cache the documents of changed requests, must be called after every change of a request
+
+    :param requests: documents returned by the changes, with the new version
+    """
+    if Config.REQUEST_CACHE:
+        await request_cache.set(*requests)
+
+
+async def update_deadlines(*requests):
+    """Schedule or cancel the deadlines of created or changed requests (see utils.deadlines)
+
+    :param requests: documents of the requests with _id, employee_id, status and date_receipt
+    """
+    consideration, execution, assigned, finished = {}, {}, [], []
+    for request in requests:
+        request_id = str(request['_id'])
+        if request['status'] == 'finished':
+            finished.append(request_id)
+        elif request['employee_id']:
+            assigned.append(request_id)
+            execution[request_id] = execution_deadline(request['date_receipt'])
+        else:
+            consideration[request_id] = consideration_deadline(request['date_receipt'])
+    await deadline_timer.schedule(CONSIDERATION, consideration)
+    await deadline_timer.schedule(EXECUTION, execution)
+    await deadline_timer.cancel(CONSIDERATION, *assigned, *finished)
+    await deadline_timer.cancel(EXECUTION, *finished)
+
+
+async def create_request(request: RequestIn, user_id: ObjectId) -> RequestOut:
     """Create a request
 
     :param request: object RequestIn with data a user for create a request
@@ -19,13 +136,17 @@ def create_request(request: RequestIn, user_id: ObjectId) -> RequestOut:
     request_db = {}
     try:
         request_db = {'user_id': user_id, 'employee_id': '', 'title': request.title, 'description': request.description,
-                      'date_receipt': request.date_receipt, 'status': 'draft'}
-        request_db['_id'] = str(request_collection.insert_one(request_db).inserted_id)
+                      'date_receipt': request.date_receipt, 'status': 'draft', 'version': 1}
+        request_db['_id'] = str((await request_collection.insert_one(request_db)).inserted_id)
     except BaseException as e:  # If an exception is raised when adding to the database
         print(f'Error: {e}')
-        if request_collection:
-            request_collection.remove({'_id': user_id})
+        if request_db.get('_id'):
+            await request_collection.delete_one({'_id': ObjectId(request_db['_id'])})
+        request_db['_id'] = None
     if request_db['_id']:
+        if Config.REQUEST_CACHE:
+            await request_cache.set(dict(request_db, _id=ObjectId(request_db['_id'])))
+        await update_deadlines(request_db)
         return RequestOut(request_id=request_db['_id'], title=request_db['title'],
                           description=request_db['description'],
                           status=request_db['status'], date_receipt=request_db['date_receipt'])
@@ -33,185 +154,266 @@ def create_request(request: RequestIn, user_id: ObjectId) -> RequestOut:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='Failed to add a request')
 
 
-def get_requests(user_data: UserInDB) -> list:
-    """Get requests the user
+async def get_request_documents(user_data: UserInDB, limit: int = None, cursor: str = None,
+                                fields: frozenset = None) -> list:
+    """Get documents of the requests the user, page by page
 
     :param user_data: object UserInDB
-    :return: request (RequestOut/RequestOutEmployee/RequestOutAdmin) list
+    :param limit: maximum number of requests on the page, all requests if None
+    :param cursor: position after the previous page (utils.pagination.encode_cursor), the first page if None
+    :param fields: sparse fieldset from select_fields, all fields if None
+    :return: list of documents, with the fields of the fieldset and version
     """
     if user_data.role == 'user':
-        cursor = request_collection.find({'user_id': user_data._id})
-        requests = [
-            RequestOut(request_id=str(request['_id']), title=request['title'], description=request['description'],
-                       status=request['status'], date_receipt=request['date_receipt']) for request in cursor]
+        query = {'user_id': user_data._id}
     elif user_data.role == 'employee':
-        cursor = request_collection.find({'employee_id': user_data._id})
-        requests = [
-            RequestOutEmployee(request_id=str(request['_id']), user_id=str(request['user_id']), title=request['title'],
-                               description=request['description'], status=request['status'],
-                               date_receipt=request['date_receipt']) for request in cursor]
+        query = {'employee_id': user_data._id}
     elif user_data.role == 'admin':
-        cursor = request_collection.find({'status': {'$not': {'$eq': 'draft'}}})
-        requests = [
-            RequestOutAdmin(request_id=str(request['_id']), user_id=str(request['user_id']),
-                            employee_id=str(request['employee_id']), title=request['title'],
-                            description=request['description'], status=request['status'],
-                            date_receipt=request['date_receipt']) for request in cursor]
+        query = {'status': {'$not': {'$eq': 'draft'}}}
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid user')
-    if requests:
+    if cursor is not None:
+        query = {'$and': [query, keyset_filter(cursor)]}
+    documents = request_collection.find(query, projection(fields)).sort(SORT_REQUESTS)
+    if limit:
+        documents = documents.limit(limit)
+
+    requests = [request async for request in documents]
+    if requests or cursor is not None:  # The page after the last one is empty
         return requests
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This {user_data.role} does not have'
                                                                             ' any requests')
 
 
-def get_request(request_id: str, user_data: UserInDB) -> RequestOut:
-    """ Get request by a id request
+async def get_requests(user_data: UserInDB, limit: int = None, cursor: str = None, fields: frozenset = None) -> list:
+    """Get requests the user, page by page
 
-    :param request_id: id request
     :param user_data: object UserInDB
-    :return: data the request
+    :param limit: maximum number of requests on the page, all requests if None
+    :param cursor: position after the previous page (utils.pagination.encode_cursor), the first page if None
+    :param fields: sparse fieldset from select_fields, all fields if None
+    :return: request (RequestOut/RequestOutEmployee/RequestOutAdmin) list
     """
+    documents = await get_request_documents(user_data, limit, cursor, fields)
+    return [request_out(request, user_data.role, fields) for request in documents]
+
+
+async def export_requests(batch_size: int):
+    """Iterate over all requests visible to the admin without loading them into memory
 
+    :param batch_size: number of documents fetched from MongoDB per round trip
+    :return: asynchronous generator of RequestOutAdmin
+    """
+    documents = request_collection.find({'status': {'$not': {'$eq': 'draft'}}}).sort(SORT_REQUESTS)
+    async for request in documents.batch_size(batch_size):
+        yield request_out(request, 'admin')
+
+
+async def get_request_document(request_id: str, user_data: UserInDB, fields: frozenset = None) -> dict:
+    """ Get document of a request by a id request
+
+    :param request_id: id request
+    :param user_data: object UserInDB
+    :param fields: sparse fieldset from select_fields, all fields if None
+    :return: the document, with at least the fields of the fieldset and version
+    """
     if user_data.role == 'user':
-        request = request_collection.find_one({'$and': [
-            {'_id': ObjectId(request_id)},
-            {'user_id': user_data._id}
-        ]})
-        if request:
-            return RequestOut(request_id=str(request['_id']), title=request['title'],
-                              description=request['description'], status=request['status'],
-                              date_receipt=request['date_receipt'])
-        else:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='This user does not have request with '
-                                                                                f'id={request_id}')
+        query = {'$and': [{'_id': ObjectId(request_id)}, {'user_id': user_data._id}]}
+        error = f'This user does not have request with id={request_id}'
     elif user_data.role == 'employee':
-        request = request_collection.find_one({'$and': [
-            {'_id': ObjectId(request_id)},
-            {'employee_id': user_data._id}
-        ]})
-        if request:
-            return RequestOutEmployee(request_id=str(request['_id']), user_id=str(request['user_id']),
-                                      title=request['title'], description=request['description'],
-                                      status=request['status'], date_receipt=request['date_receipt'])
-        else:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail=f'This request ({request_id}) does not exist')
+        query = {'$and': [{'_id': ObjectId(request_id)}, {'employee_id': user_data._id}]}
+        error = f'This request ({request_id}) does not exist'
     elif user_data.role == 'admin':
-        request = request_collection.find_one({'$and': [
-            {'_id': ObjectId(request_id)},
-            {'status': {'$not': {'$eq': 'draft'}}}
-        ]})
-        if request:
-            return RequestOutAdmin(request_id=str(request['_id']), user_id=str(request['user_id']),
-                                   employee_id=request['employee_id'], title=request['title'],
-                                   description=request['description'], status=request['status'],
-                                   date_receipt=request['date_receipt'])
-        else:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail=f'This request ({request_id}) does not exist')
+        query = {'$and': [{'_id': ObjectId(request_id)}, {'status': {'$not': {'$eq': 'draft'}}}]}
+        error = f'This request ({request_id}) does not exist'
+    else:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid user')
+    if Config.REQUEST_CACHE:
+        request = await request_cache.get(request_id)
+        if request is None:
+            request = await request_collection.find_one({'_id': ObjectId(request_id)})
+            if request:
+                await request_cache.set(request)
+        if request and not can_read(request, user_data):
+            request = None
+    else:
+        request = await request_collection.find_one(query, projection(fields))
+    if request:
+        return request
+    else:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error)
 
 
-def edit_request(request_id: str, title: str = None, description: str = None) -> RequestOut:
-    """Edit request
+async def get_request(request_id: str, user_data: UserInDB, fields: frozenset = None) -> RequestOut:
+    """ Get request by a id request
+
+    :param request_id: id request
+    :param user_data: object UserInDB
+    :param fields: sparse fieldset from select_fields, all fields if None
+    :return: data the request
+    """
+    request = await get_request_document(request_id, user_data, fields)
+    return request_out(request, user_data.role, fields)
+
+
+async def edit_request(request_id: str, title: str = None, description: str = None) -> RequestOut:
+    """Edit request, only a request in the draft status can be edited
 
     :param request_id: id request
     :param title: new title request
     :param description: new description request
     :return: data the request
     """
-    request = request_collection.find_one({'_id': ObjectId(request_id)})
+    changes = {field: value for field, value in (('title', title), ('description', description)) if value is not None}
+    if changes:
+        request = await request_collection.find_one_and_update({'_id': ObjectId(request_id), 'status': 'draft'},
+                                                               {'$set': changes, '$inc': {'version': 1}},
+                                                               return_document=ReturnDocument.AFTER)
+    else:
+        request = await request_collection.find_one({'_id': ObjectId(request_id), 'status': 'draft'})
+    if request:
+        if changes:
+            await cache_requests(request)
+        return request_out(request, 'user')
+
+    request = await request_collection.find_one({'_id': ObjectId(request_id)}, {'status': 1})
     if not request:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='This user does not have request with id='
                                                                             f'{request_id}')
-    if request['status'] == 'draft':
-        result = 0  # The modified flag
-        if title is not None and title != request['title']:
-            result = request_collection.update_one({'_id': ObjectId(request_id)},
-                                                   {'$set': {"title": title}}).modified_count
-        if description is not None and description != request['description']:
-            result = request_collection.update_one({'_id': ObjectId(request_id)},
-                                                   {'$set': {"description": description}}).modified_count
-        if result:
-            request = request_collection.find_one({'_id': ObjectId(request_id)})
-            return RequestOut(request_id=str(request['_id']), title=request['title'],
-                              description=request['description'], status=request['status'],
-                              date_receipt=request['date_receipt'])
-        else:
-            return RequestOut(request_id=str(request['_id']), title=request['title'],
-                              description=request['description'], status=request['status'],
-                              date_receipt=request['date_receipt'])
-    else:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='The status of the request '
-                                                                            f'{request["status"]}')
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='The status of the request '
+                                                                        f'{request["status"]}')
 
 
-def edit_status_request(request_id: str, user: UserInDB) -> RequestOut:
-    """Edit status request
+async def edit_status_request(request_id: str, user: UserInDB) -> RequestOut:
+    """Move request to the next status (see STATUS_TRANSITIONS) with one conditional update
 
     :param request_id: id request
     :param user: object UserInDB
     :return: data the request
     """
-    request = request_collection.find_one({'_id': ObjectId(request_id)})
+    transitions = STATUS_TRANSITIONS.get(user.role)
+    if transitions is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid user')
+    query = {'_id': ObjectId(request_id), 'status': {'$in': list(transitions)}}
+    if user.role == 'user':
+        query['user_id'] = user._id
+    elif user.role == 'employee':
+        query['employee_id'] = user._id
+    branches = [{'case': {'$eq': ['$status', current]}, 'then': new} for current, new in transitions.items()]
+    request = await request_collection.find_one_and_update(
+        query, [{'$set': {'status': {'$switch': {'branches': branches, 'default': '$status'}},
+                          'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]}}}],
+        return_document=ReturnDocument.AFTER)
+    if request:
+        await cache_requests(request)
+        await update_deadlines(request)
+        return request_out(request, user.role)
+
+    # The transition is not allowed, find out why
+    request = await request_collection.find_one({'_id': ObjectId(request_id)},
+                                                {'status': 1, 'user_id': 1, 'employee_id': 1})
     if not request:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='This user does not have request with id='
                                                                             f'{request_id}')
-    if user.role == 'user' and user._id == request['user_id']:
-        if request['status'] == 'draft':
-            result = request_collection.update_one({'_id': ObjectId(request_id)},
-                                                   {'$set': {"status": 'active'}}).modified_count
-        else:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This request ({request_id}) '
-                                                                                f'has the active status')
-    elif user.role == 'admin' or (user.role == 'employee' and request['employee_id'] == user._id):
-        if request['status'] == 'active':
-            result = request_collection.update_one({'_id': ObjectId(request_id)},
-                                                   {'$set': {"status": 'in_progress'}}).modified_count
-        elif request['status'] == 'in_progress':
-            result = request_collection.update_one({'_id': ObjectId(request_id)},
-                                                   {'$set': {"status": 'finished'}}).modified_count
-        elif request['status'] == 'finished':
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This request ({request_id}) '
-                                                                                f'has the finished status')
-        else:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This request ({request_id}) '
-                                                                                f'has the draft status')
-    else:
+    if (user.role == 'user' and request['user_id'] != user._id) or \
+            (user.role == 'employee' and request['employee_id'] != user._id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f'This {user.role} does not have request with id={request_id}')
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This request ({request_id}) '
+                                                                        f'has the {request["status"]} status')
+
+
+async def assign_employee_to_request(employee_id: str, request_id: str,
+                                     admin: UserInDB) -> Union[RequestOutAdmin, RequestOut]:
+    """Assign an employee to a request in the active status
+
+    :param employee_id: id employee
+    :param request_id: id request
+    :param admin: object UserInDB of the admin
+    :return: data the request
+    """
+    request = await request_collection.find_one_and_update({'_id': ObjectId(request_id), 'status': 'active'},
+                                                           {'$set': {"employee_id": ObjectId(employee_id)},
+                                                            '$inc': {'version': 1}},
+                                                           return_document=ReturnDocument.AFTER)
+    if request:
+        await cache_requests(request)
+        await update_deadlines(request)
+        return request_out(request, admin.role)
+    request = await request_collection.find_one({'_id': ObjectId(request_id)}, {'status': 1})
+    if not request or request['status'] == 'draft':
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'This request ({request_id}) does not exist')
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This request ({request_id}) '
+                                                                        f'does not have the active status')
+
 
-    if result:
-        request = request_collection.find_one({'_id': ObjectId(request_id)})
-        if user.role == 'user':
-            return RequestOut(request_id=str(request['_id']), title=request['title'],
-                              description=request['description'], status=request['status'],
-                              date_receipt=request['date_receipt'])
-        elif user.role == 'employee':
-            return RequestOutEmployee(request_id=str(request['_id']), user_id=str(request['user_id']),
-                                      title=request['title'], description=request['description'],
-                                      status=request['status'], date_receipt=request['date_receipt'])
-        elif user.role == 'admin':
-            return RequestOutAdmin(request_id=str(request['_id']), user_id=str(request['user_id']),
-                                   employee_id=request['employee_id'], title=request['title'],
-                                   description=request['description'], status=request['status'],
-                                   date_receipt=request['date_receipt'])
+async def create_requests(requests: list, user_id: ObjectId) -> list:
+    """Create several requests with one insert
+
+    :param requests: list of RequestIn
+    :param user_id: id of the user creating the requests
+    :return: list of BulkItemResult in the order of the requests
+    """
+    if not requests:
+        return []
+    requests_db = [{'user_id': user_id, 'employee_id': '', 'title': request.title,
+                    'description': request.description, 'date_receipt': request.date_receipt, 'status': 'draft',
+                    'version': 1} for request in requests]
+    errors = {}
+    try:
+        await request_collection.insert_many(requests_db, ordered=False)
+    except BulkWriteError as error:
+        errors = {write_error['index']: write_error['errmsg'] for write_error in error.details['writeErrors']}
+    await update_deadlines(*(request_db for index, request_db in enumerate(requests_db) if index not in errors))
+    return [BulkItemResult(index=index, request_id=None if index in errors else str(request_db['_id']),
+                           error=errors.get(index)) for index, request_db in enumerate(requests_db)]
+
+
+async def assign_employees_to_requests(assignments: list) -> list:
+    """Assign employees to requests in the active status, the updates run concurrently
+
+    An assignment fails when its request is not active at the time of the update
+    or when several assignments of the list have the same request.
+
+    :param assignments: list of RequestAssign
+    :return: list of BulkItemResult in the order of the assignments
+    """
+    errors = {}
+    for index, assignment in enumerate(assignments):
+        if not (ObjectId.is_valid(assignment.employee_id) and ObjectId.is_valid(assignment.request_id)):
+            errors[index] = 'Invalid id'
+    valid = [index for index in range(len(assignments)) if index not in errors]
+    counts = Counter(ObjectId(assignments[index].request_id) for index in valid)
+    employees = {employee['_id'] async for employee in user_collection.find(
+        {'_id': {'$in': [ObjectId(assignments[index].employee_id) for index in valid]}, 'role': 'employee'},
+        {'_id': 1})}
+    updates = {}
+    for index in valid:
+        employee_id, request_id = ObjectId(assignments[index].employee_id), ObjectId(assignments[index].request_id)
+        if counts[request_id] > 1:
+            errors[index] = f'This request ({request_id}) is assigned more than once'
+        elif employee_id not in employees:
+            errors[index] = f'The employee ({employee_id}) does not exist'
         else:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid user')
-
-
-def assign_employee_to_request(employee_id: str, request_id: str,
-                               admin: UserInDB) -> Union[RequestOutAdmin, RequestOut]:
-    request = get_request(request_id, admin)
-    if request.status != 'active':
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'This request ({request_id}) '
-                                                                            f'does not have the active status')
-    result = request_collection.update_one({'_id': ObjectId(request_id)},
-                                           {'$set': {"employee_id": ObjectId(employee_id)}}).modified_count
-    if result:
-        return RequestOutAdmin(request_id=request_id, user_id=request.user_id, employee_id=employee_id,
-                               title=request.title, description=request.description, status=request.status,
-                               date_receipt=request.date_receipt)
-    else:
-        return request
+            updates[index] = request_collection.find_one_and_update(
+                {'_id': request_id, 'status': 'active'},
+                {'$set': {'employee_id': employee_id}, '$inc': {'version': 1}},
+                return_document=ReturnDocument.AFTER)
+    assigned = []
+    results = await asyncio.gather(*updates.values(), return_exceptions=True)
+    for index, request in zip(updates, results):
+        if isinstance(request, PyMongoError):
+            errors[index] = str(request)
+        elif isinstance(request, BaseException):
+            raise request
+        elif request is None:
+            errors[index] = f'This request ({assignments[index].request_id}) does not have the active status'
+        else:
+            assigned.append(request)
+    if assigned:
+        await cache_requests(*assigned)
+        await update_deadlines(*assigned)
+    return [BulkItemResult(index=index, request_id=assignment.request_id, error=errors.get(index))
+            for index, assignment in enumerate(assignments)]
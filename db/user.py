@@ -1,44 +1,75 @@
 from datetime import timedelta, datetime
 
 import pymongo
+from bson import ObjectId
 from fastapi import HTTPException
 from starlette import status
 
 from config import Config
 from models.user import UserIn, UserOut, UserInDB
-from utils.auth import get_password_hash, verify_password, create_access_token
-from utils.db import user_collection
+from utils.auth import get_password_hash_async, verify_password_async, create_access_token
+from utils.cache import user_cache, token_version_cache
+from utils.db import user_collection_async as user_collection
+from utils.responses import build_model
 
 
-def get_user(email: str) -> UserInDB:
+async def get_user(email: str) -> UserInDB:
     """ Get a user by email
 
     :param email: email user as name@email.com
     :return: data the user or nothing if the user doesn`t exists
     """
-    user_data = user_collection.find_one({'email': email})
+    user_data = await user_collection.find_one({'email': email})
     if user_data:
         return UserInDB(**user_data)
 
 
-def registration(user_data: UserIn, role: str = 'user') -> UserOut:
+async def get_token_version(email: str):
+    """Get the current token version of a user, tokens with another version are revoked
+
+    :param email: email user as name@email.com
+    :return: token version or None if the user doesn`t exists
+    """
+    version = token_version_cache.get(email)
+    if version is None:
+        user_data = await user_collection.find_one({'email': email}, {'token_version': 1})
+        if not user_data:
+            return None
+        version = user_data.get('token_version', 0)
+        token_version_cache.set(email, version)
+    return version
+
+
+async def revoke_tokens(email: str):
+    """Revoke all issued access tokens of a user
+
+    :param email: email user as name@email.com
+    """
+    await user_collection.update_one({'email': email}, {'$inc': {'token_version': 1}})
+    invalidate_user(email)
+
+
+async def registration(user_data: UserIn, role: str = 'user') -> UserOut:
     """Registration new a user
 
     :param user_data: object UserIn with data a user for registration
     :param role: role the user in the app
     :return: data the user
     """
-    if get_user(user_data.email):
+    if await get_user(user_data.email):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='A user with this email already exists')
+    hash_password = await get_password_hash_async(user_data.password)
     user_db = {}
     try:
-        user_db = {'email': user_data.email, 'hash_password': get_password_hash(user_data.password), 'role': role,
+        user_db = {'email': user_data.email, 'hash_password': hash_password, 'role': role,
                    'date_registration': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-        user_db['_id'] = str(user_collection.insert_one(user_db).inserted_id)
+        user_db['_id'] = str((await user_collection.insert_one(user_db)).inserted_id)
+        invalidate_user(user_data.email)
     except BaseException as e:  # If an exception is raised when adding to the database
         print(f'Error: {e}')
-        if user_collection:
-            user_collection.remove({'_id': user_db['_id']})
+        if user_db.get('_id'):
+            await user_collection.delete_one({'_id': ObjectId(user_db['_id'])})
+        user_db['_id'] = None
     if user_db['_id']:
         return UserOut(user_id=user_db['_id'], email=user_db['email'], role=role,
                        date_registration=user_db['date_registration'])
@@ -46,18 +77,30 @@ def registration(user_data: UserIn, role: str = 'user') -> UserOut:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='Failed to add a user')
 
 
-def login(user_data: UserIn) -> dict:
+def invalidate_user(email: str):
+    """Drop the cached data of a user, must be called after changing the user (role, password, ...)
+
+    :param email: email user as name@email.com
+    """
+    user_cache.invalidate(email)
+    token_version_cache.invalidate(email)
+
+
+async def login(user_data: UserIn) -> dict:
     """User authorization
 
     :param user_data: object UserIn with data a user for registration
     :return: Dictionary with access token and token type
     """
-    user = user_collection.find_one({'email': user_data.email})
+    user = await user_collection.find_one({'email': user_data.email})
     if user:
-        if verify_password(user_data.password, user['hash_password']):
+        if await verify_password_async(user_data.password, user['hash_password']):
             access_token_expires = timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES)
+            data = {"sub": user_data.email}
+            if Config.AUTH_TOKEN_CLAIMS:
+                data.update({"uid": str(user['_id']), "role": user['role'], "ver": user.get('token_version', 0)})
             access_token = create_access_token(
-                data={"sub": user_data.email}, expires_delta=access_token_expires
+                data=data, expires_delta=access_token_expires
             )
             return {"access_token": access_token, "token_type": "bearer"}
         else:
@@ -69,14 +112,15 @@ def login(user_data: UserIn) -> dict:
                             headers={"WWW-Authenticate": "Bearer"}, )
 
 
-def get_employees() -> list:
+async def get_employees() -> list:
     """Get users with the employee role
 
     :return: list employees (UserOut)
     """
     employees = user_collection.find({'role': 'employee'}).sort('date_registration', pymongo.DESCENDING)
     if employees:
-        return [UserOut(user_id=str(employee['_id']), email=employee['email'], role=employee['role'],
-                        date_registration=employee['date_registration']) for employee in employees]
+        return [build_model(UserOut, {'user_id': str(employee['_id']), 'email': employee['email'],
+                                      'role': employee['role'], 'date_registration': employee['date_registration']})
+                async for employee in employees]
     else:
         return []
@@ -0,0 +1,53 @@
+"""Production server: gunicorn managing uvicorn worker processes
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The number of workers is WEB_WORKERS or the number of usable CPUs. Every worker creates its own
+MongoDB, Redis and password hashing resources after fork (see utils.db, utils.request_cache, utils.pool).
+Send HUP to the master to replace the workers gracefully with the new code and configuration,
+TERM to drain: the workers stop accepting connections and finish the requests in progress
+during WEB_GRACEFUL_TIMEOUT seconds.
+
+The settings are read from the environment here: importing config (or the app, see WEB_PRELOAD)
+in the master would keep the old modules in the workers forked after HUP.
+"""
+import os
+import shutil
+
+
+def usable_cpus() -> int:
+    """Number of CPUs the process may run on, less than os.cpu_count() in a container with cpusets"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        return os.cpu_count() or 1
+
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('WEB_WORKERS', 0)) or usable_cpus()
+worker_class = 'uvicorn.workers.UvicornWorker'
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+# Restart a worker after a number of requests, with jitter so the workers don't restart together
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+# Preloading shares the imported code between the workers but HUP no longer loads new code
+preload_app = os.environ.get('WEB_PRELOAD', 'false').lower() == 'true'
+
+# The bcrypt processes of all workers share the CPUs instead of each worker starting one per CPU,
+# the workers inherit the environment of the master and read it when they import config
+os.environ.setdefault('PASSWORD_HASH_WORKERS', str(max(1, usable_cpus() // workers)))
+
+
+def on_starting(server):
+    # The metrics of the previous run of the workers must not be aggregated with the new ones
+    directory = os.environ.get('prometheus_multiproc_dir')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,7 +1,10 @@
 from datetime import datetime
+from functools import lru_cache
 
 from bson.objectid import ObjectId
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, conlist, create_model
+
+from config import Config
 
 
 class RequestIn(BaseModel):
@@ -27,6 +30,39 @@ class RequestOutAdmin(RequestOut):
     employee_id: str
 
 
+# The response model of a request by the role of the user
+RESPONSE_MODELS = {'user': RequestOut, 'employee': RequestOutEmployee, 'admin': RequestOutAdmin}
+
+
+@lru_cache(maxsize=None)
+def partial_model(role: str, fields: frozenset):
+    """Create the response model of a sparse fieldset
+
+    :param role: role of the user (user/employee/admin)
+    :param fields: names of the fields of the role's response model
+    :return: pydantic model with only these fields
+    """
+    model = RESPONSE_MODELS[role]
+    definitions = {name: (field.outer_type_, ...) for name, field in model.__fields__.items() if name in fields}
+    return create_model(f'{model.__name__}Partial', **definitions)
+
+
+class RequestAssign(BaseModel):
+    employee_id: str = Field(..., description='The id of an employee')
+    request_id: str = Field(..., description='The id of a request')
+
+
+# Bodies of the bulk endpoints, the number of items is checked before the items are validated
+RequestInList = conlist(RequestIn, max_items=Config.BULK_MAX_ITEMS)
+RequestAssignList = conlist(RequestAssign, max_items=Config.BULK_MAX_ITEMS)
+
+
+class BulkItemResult(BaseModel):
+    index: int = Field(..., description='Position of the item in the request body')
+    request_id: str = Field(None, description='The id of a request')
+    error: str = Field(None, description='Why the item failed, empty if it succeeded')
+
+
 class RequestInDB:
     def __init__(self, **kwargs):
         self._id: ObjectId = kwargs['_id']
@@ -1,8 +1,8 @@
 from fastapi import status, Body, APIRouter
 
-from celery_app import send_email
 from models.user import UserIn, UserOut, Token
 import db.user as db_user
+from utils.tasks import send_email
 router = APIRouter()
 
 
@@ -13,9 +13,9 @@ async def registration(user_data: UserIn = Body(
         "email": "name@email.ru",
         "password": "password"
     })):
-    result = db_user.registration(user_data)
-    send_email.delay(user_data.email, title='Registering with realty-service',
-                     description=f'The user {user_data.email} was created successfully.')
+    result = await db_user.registration(user_data)
+    send_email(user_data.email, title='Registering with realty-service',
+               description=f'The user {user_data.email} was created successfully.')
     return result
 
 
@@ -26,4 +26,4 @@ async def login(user_data: UserIn = Body(
         "email": "name@email.ru",
         "password": "password"
     })):
-    return db_user.login(user_data)
\ No newline at end of file
+    return await db_user.login(user_data)
\ No newline at end of file
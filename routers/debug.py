@@ -0,0 +1,19 @@
+from fastapi import status, APIRouter, HTTPException, Header
+
+from config import Config
+from utils.auth import get_current_user
+from utils.profiler import recent_profiles, slow_queries
+
+router = APIRouter()
+
+
+@router.get('/profiler', status_code=status.HTTP_200_OK)
+async def get_profiles(over_budget: bool = False, jwt: str = Header(..., example='key')):
+    user = await get_current_user(jwt)
+    if user.role != 'admin':
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='No access rights')
+    if not Config.PROFILER:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='The profiler is disabled')
+    profiles = [profile for profile in recent_profiles if profile['over_budget'] or not over_budget]
+    return {'query_budget': Config.QUERY_BUDGET, 'slow_query_ms': Config.SLOW_QUERY_MS,
+            'profiles': profiles, 'slow_queries': list(slow_queries)}
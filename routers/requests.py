@@ -1,12 +1,28 @@
-from fastapi import status, Body, HTTPException, APIRouter, Header
+from fastapi import status, Body, HTTPException, APIRouter, Header, Query
+from starlette.responses import Response, StreamingResponse
 
 import db.requests as db_request
+from config import Config
 from utils.auth import get_current_user
-from models.requests import RequestIn, RequestOut
+from utils.etag import etag_matches, request_etag
+from utils.export import to_csv, to_ndjson
+from utils.pagination import encode_cursor
+from utils.responses import respond
+from models.requests import RequestIn, RequestInList, RequestOut
 
 router = APIRouter()
 
 
+def split_fields(fields: str = None) -> list:
+    """Split the fields query parameter (title,status)
+
+    :param fields: comma separated names of fields
+    :return: list of names or None
+    """
+    if fields:
+        return [field.strip() for field in fields.split(',') if field.strip()]
+
+
 @router.post("", status_code=status.HTTP_201_CREATED, response_model=RequestOut)
 async def create_request(request_data: RequestIn = Body(
     ...,
@@ -15,31 +31,75 @@ async def create_request(request_data: RequestIn = Body(
         "description": "Description request",
         "date_receipt": "2020-03-29 14:10:00"
     }), jwt: str = Header(..., example='key')):
-    user = get_current_user(jwt)
-    response = db_request.create_request(request_data, user._id)
+    user = await get_current_user(jwt)
+    response = await db_request.create_request(request_data, user._id)
 
-    return response
+    return respond(response, status.HTTP_201_CREATED)
+
+
+@router.post("/bulk", status_code=status.HTTP_201_CREATED)
+async def create_requests(requests_data: RequestInList = Body(
+    ...,
+    example=[{
+        "title": "Title request",
+        "description": "Description request",
+        "date_receipt": "2020-03-29 14:10:00"
+    }]), jwt: str = Header(..., example='key')):
+    user = await get_current_user(jwt)
+    results = await db_request.create_requests(requests_data, user._id)
+    return respond({'results': results}, status.HTTP_201_CREATED)
 
 
 @router.get("", status_code=status.HTTP_200_OK)
-async def get_requests(jwt: str = Header(..., example='key')):
-    user = get_current_user(jwt)
-    requests = db_request.get_requests(user)
-    return {'requests': [request for request in requests]}
+async def get_requests(limit: int = Query(Config.REQUESTS_PAGE_SIZE, ge=1, le=Config.REQUESTS_MAX_PAGE_SIZE),
+                       cursor: str = None, fields: str = Query(None, example='title,status'),
+                       view: str = Query('full', regex='^(full|compact)$'), if_none_match: str = Header(None),
+                       jwt: str = Header(..., example='key')):
+    user = await get_current_user(jwt)
+    selected_fields = db_request.select_fields(user.role, split_fields(fields), compact=view == 'compact')
+    documents = await db_request.get_request_documents(user, limit, cursor, selected_fields)
+    next_cursor = None
+    if len(documents) == limit:
+        next_cursor = encode_cursor(documents[-1]['date_receipt'], documents[-1]['_id'])
+    etag = request_etag(documents, user.role, selected_fields, next_cursor)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    requests = [db_request.request_out(request, user.role, selected_fields) for request in documents]
+    return respond({'requests': requests, 'next_cursor': next_cursor}, headers={'ETag': etag})
+
+
+@router.get("/export", status_code=status.HTTP_200_OK)
+async def export_requests(export_format: str = Query('ndjson', alias='format', regex='^(ndjson|csv)$'),
+                          batch_size: int = Query(Config.EXPORT_BATCH_SIZE, ge=1, le=10000),
+                          jwt: str = Header(..., example='key')):
+    user = await get_current_user(jwt)
+    if user.role != 'admin':
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='No access rights')
+    rows = db_request.export_requests(batch_size)
+    if export_format == 'csv':
+        return StreamingResponse(to_csv(rows), media_type='text/csv',
+                                 headers={'Content-Disposition': 'attachment; filename="requests.csv"'})
+    return StreamingResponse(to_ndjson(rows), media_type='application/x-ndjson')
 
 
 @router.get("/{request_id}", status_code=status.HTTP_200_OK)
-async def get_request(request_id: str, jwt: str = Header(..., example='key')):
-    user = get_current_user(jwt)
-    return db_request.get_request(request_id, user)
+async def get_request(request_id: str, fields: str = Query(None, example='title,status'),
+                      if_none_match: str = Header(None), jwt: str = Header(..., example='key')):
+    user = await get_current_user(jwt)
+    selected_fields = db_request.select_fields(user.role, split_fields(fields))
+    document = await db_request.get_request_document(request_id, user, selected_fields)
+    etag = request_etag([document], user.role, selected_fields)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return respond(db_request.request_out(document, user.role, selected_fields), headers={'ETag': etag})
 
 
 @router.patch("/{request_id}", status_code=status.HTTP_200_OK, response_model=RequestOut)
 async def edit_request(request_id: str, title: str = None, description: str = None,
                        jwt: str = Header(..., example='key')) -> RequestOut:
-    if get_current_user(jwt):
+    if await get_current_user(jwt):
         if title or description:
-            return db_request.edit_request(request_id, title, description)
+            return respond(await db_request.edit_request(request_id, title, description))
         else:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail='The Title and Description fields are empty')
@@ -47,5 +107,5 @@ async def edit_request(request_id: str, title: str = None, description: str = No
 
 @router.patch("/status/{request_id}", status_code=status.HTTP_200_OK)
 async def edit_status_request(request_id: str, jwt: str = Header(..., example='key')):
-    user = get_current_user(jwt)
-    return db_request.edit_status_request(request_id, user)
+    user = await get_current_user(jwt)
+    return respond(await db_request.edit_status_request(request_id, user))
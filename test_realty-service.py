@@ -3,6 +3,7 @@ from tests.routers import *
 from tests.db import *
 from tests.celery import *
 from tests.auth import *
+from tests.benchmarks import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,20 @@
+import os
 import unittest
 from datetime import timedelta
 
+import mock
 from fastapi import HTTPException
+from prometheus_client import REGISTRY
 from pytest import raises
 
 from config import Config
-from db.user import registration
+from db.user import registration, login, get_user, revoke_tokens
 from models.user import UserInDB, UserIn
-from utils.auth import create_access_token, get_current_user
+from utils.auth import create_access_token, get_current_user, get_password_hash, verify_password
+from utils.cache import TTLCache, user_cache
 from utils.db import user_collection, request_collection
+from utils.pool import BoundedProcessPool
+from tests.utils import run
 
 
 class TestOAuth:
@@ -17,7 +23,7 @@ class TestOAuth:
         cls.email = 'admin@example.com'
         cls.jwt = None
         cls.access_token_expires = timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES)
-        registration(UserIn(email='admin@example.com', password='admin'), 'admin')
+        run(registration(UserIn(email='admin@example.com', password='admin'), 'admin'))
 
     def teardown_class(cls):
         user_collection.delete_many({})
@@ -31,19 +37,139 @@ class TestOAuth:
         TestOAuth.jwt = access_token.decode()
 
     def test_get_current_user(self):
-        result = get_current_user(self.jwt)
+        result = run(get_current_user(self.jwt))
         assert type(result) is UserInDB
 
     def test_get_current_user_no_email(self):
         access_token = create_access_token(data={}, expires_delta=self.access_token_expires)
         with raises(HTTPException):
-            assert get_current_user(access_token.decode())
+            assert run(get_current_user(access_token.decode()))
 
     def test_get_current_user_doesnt_exists(self):
         access_token = create_access_token(data={'sub': 'not_exists@email.ru'},
                                            expires_delta=self.access_token_expires)
         with raises(HTTPException):
-            assert get_current_user(access_token.decode())
+            assert run(get_current_user(access_token.decode()))
+
+    def test_get_current_user_cached(self):
+        run(get_current_user(self.jwt))
+        hits = user_cache.hits
+        result = run(get_current_user(self.jwt))
+        assert type(result) is UserInDB
+        assert user_cache.hits == hits + 1
+
+    @mock.patch.object(Config, 'AUTH_TOKEN_CLAIMS', True)
+    def test_get_current_user_claims(self):
+        access_token = run(login(UserIn(email=self.email, password='admin')))['access_token']
+        result = run(get_current_user(access_token.decode()))
+        assert type(result) is UserInDB
+        assert result.role == 'admin'
+        assert result._id == run(get_user(self.email))._id
+
+    @mock.patch.object(Config, 'AUTH_TOKEN_CLAIMS', True)
+    def test_get_current_user_claims_revoked(self):
+        access_token = run(login(UserIn(email=self.email, password='admin')))['access_token']
+        run(revoke_tokens(self.email))
+        with raises(HTTPException):
+            assert run(get_current_user(access_token.decode()))
+
+
+class TestTTLCache:
+
+    def setup_method(self):
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_get_set(self):
+        self.cache.set('a', 1)
+        assert self.cache.get('a') == 1
+        assert self.cache.get('b') is None
+        assert self.cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    def test_expired(self):
+        self.cache.set('a', 1)
+        self.now = 10
+        assert self.cache.get('a') is None
+        assert self.cache.stats()['size'] == 0
+
+    def test_evict_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        assert self.cache.get('b') is None
+        assert self.cache.get('a') == 1
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.cache.invalidate('a')
+        self.cache.invalidate('b')
+        assert self.cache.get('a') is None
+
+    def test_metrics(self):
+        cache = TTLCache(maxsize=2, ttl=10, timer=lambda: self.now, name='test')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        assert REGISTRY.get_sample_value('cache_lookups_total', {'cache': 'test', 'result': 'hit'}) == 1
+        assert REGISTRY.get_sample_value('cache_lookups_total', {'cache': 'test', 'result': 'miss'}) == 1
+
+
+class TestBoundedProcessPool:
+
+    def test_run(self):
+        pool = BoundedProcessPool(workers=1, max_pending=1)
+        hashed = run(pool.run(get_password_hash, 'password'))
+        assert run(pool.run(verify_password, 'password', hashed)) is True
+        assert pool.stats()['completed'] == 2
+        pool.shutdown()
+
+    def test_saturated(self):
+        pool = BoundedProcessPool(workers=1, max_pending=0)
+        with raises(HTTPException) as error:
+            run(pool.run(get_password_hash, 'password'))
+        assert error.value.status_code == 429
+        assert pool.stats()['rejected'] == 1
+
+    def test_after_fork(self):
+        pool = BoundedProcessPool(workers=1, max_pending=1)
+        run(pool.run(get_password_hash, 'password'))
+        inherited = pool._executor
+        pool._pid = -1  # As in a child process forked after the first call
+        run(pool.run(get_password_hash, 'password'))
+        assert pool._executor is not inherited
+        pool.shutdown()
+        inherited.shutdown()
+
+    def test_failed(self):
+        pool = BoundedProcessPool(workers=0, max_pending=1)
+        with raises(ValueError):
+            run(pool.run(int, 'not a number'))
+        assert pool.stats()['completed'] == 0
+        assert pool.stats()['failed'] == 1
+
+    def test_metrics(self):
+        pool = BoundedProcessPool(workers=0, max_pending=1, name='test')
+        run(pool.run(int, '1'))
+        with raises(ValueError):
+            run(pool.run(int, 'not a number'))
+        pool.max_pending = 0
+        with raises(HTTPException):
+            run(pool.run(int, '1'))
+        for result in ('completed', 'failed', 'rejected'):
+            assert REGISTRY.get_sample_value('process_pool_calls_total', {'pool': 'test', 'result': result}) == 1
+        assert REGISTRY.get_sample_value('process_pool_pending', {'pool': 'test'}) == 0
+
+    def test_broken_pool(self):
+        pool = BoundedProcessPool(workers=1, max_pending=1)
+        with raises(HTTPException) as error:
+            run(pool.run(os._exit, 1))  # The process of the pool dies
+        assert error.value.status_code == 503
+        assert pool.stats()['failed'] == 1
+        assert run(pool.run(verify_password, 'password', get_password_hash('password'))) is True
+        assert pool.stats()['completed'] == 1
+        pool.shutdown()
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,59 @@
+import unittest
+
+from pytest import approx, raises
+
+from benchmarks.load import Recorder, parse_mix, percentile, summarize
+
+
+class TestLoad:
+
+    def test_percentile(self):
+        samples = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+        assert percentile(samples, 50) == 0.5
+        assert percentile(samples, 95) == 1.0
+        assert percentile(samples, 91) == 1.0
+        assert percentile(samples, 90) == 0.9
+
+    def test_percentile_bounds(self):
+        samples = [0.1, 0.2, 0.3]
+        assert percentile(samples, 0) == 0.1
+        assert percentile(samples, 100) == 0.3
+        assert percentile([0.4], 99) == 0.4
+        with raises(ValueError):
+            percentile(samples, 101)
+        with raises(ValueError):
+            percentile(samples, -1)
+
+    def test_percentile_empty(self):
+        assert percentile([], 50) == 0.0
+        assert percentile([], 100) == 0.0
+
+    def test_parse_mix(self):
+        assert parse_mix('login=1, list=10,get') == {'login': 1.0, 'list': 10.0, 'get': 1.0}
+        assert parse_mix('login=0,list=2') == {'login': 0.0, 'list': 2.0}
+
+    def test_parse_mix_invalid(self):
+        for mix in ('unknown=1', 'list=abc', 'list=-1', 'list=nan', 'list=inf', 'login=0,list=0', ''):
+            with raises(ValueError):
+                parse_mix(mix)
+
+    def test_summarize(self):
+        recorder = Recorder()
+        for seconds, status_code in ((0.01, 200), (0.02, 200), (0.03, 429), (0.04, 500), (0.05, 0)):
+            recorder.record('GET /requests', seconds, status_code)
+        recorder.record('POST /login', 0.1, 200)
+        rows = summarize(recorder, 2.0)
+        assert [row['endpoint'] for row in rows] == ['GET /requests', 'POST /login']
+        assert rows[0] == {'endpoint': 'GET /requests', 'count': 5, 'rps': 2.5, 'rejected': 1, 'errors': 2,
+                           'p50': approx(30.0), 'p95': approx(50.0), 'p99': approx(50.0), 'max': approx(50.0)}
+        assert rows[1]['p50'] == rows[1]['max'] == approx(100.0)
+
+    def test_summarize_no_elapsed(self):
+        recorder = Recorder()
+        recorder.record('GET /requests', 0.01, 200)
+        assert summarize(recorder, 0)[0]['rps'] == 0.0
+        assert summarize(Recorder(), 1.0) == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,28 @@
+import json
+import os
+import smtplib
+import tempfile
+import time
 import unittest
 from datetime import datetime, timedelta
 
 from bson import ObjectId
 import mock
+from prometheus_client import REGISTRY
 
 import celery_app
+from config import Config
 from db import requests
 from models.requests import RequestIn
 from models.user import UserIn, UserInDB
 from db.user import registration
 from utils.auth import get_password_hash
-from utils.db import user_collection, request_collection
+from utils.db import user_collection, request_collection, notification_collection
+from utils.deadlines import CONSIDERATION, EXECUTION, DeadlineTimer, consideration_deadline
+from utils import tracing
+from utils.ledger import filter_not_notified, record_notified
+from utils.smtp import SMTPPool
+from tests.utils import run
 
 
 class TestCelery:
@@ -24,12 +36,12 @@ class TestCelery:
 
         cls.employee = {'_id': None, 'email': 'employee@celery.ru', 'password': 'employee'}
         cls.employee_in = UserIn(email=cls.employee['email'], password=cls.employee['password'])
-        cls.employee['_id'] = registration(cls.employee_in, role='employee').user_id
+        cls.employee['_id'] = run(registration(cls.employee_in, role='employee')).user_id
 
         cls.user = {'_id': None, 'email': 'user@celery.ru', 'password': 'user', 'role': 'user',
                     'date_registration': None}
         cls.user_in = UserIn(email=cls.user['email'], password=cls.user['password'])
-        data_user = registration(cls.user_in)
+        data_user = run(registration(cls.user_in))
         cls.user['_id'] = data_user.user_id
         cls.user['date_registration'] = data_user.date_registration
         cls.user_in_db = UserInDB(_id=ObjectId(cls.user['_id']), email=cls.user['email'],
@@ -40,14 +52,15 @@ class TestCelery:
                        'date_receipt': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'status': None}
         cls.request_in = RequestIn(title=cls.request['title'], description=cls.request['description'],
                                    date_receipt=cls.request['date_receipt'])
-        cls.request['_id'] = requests.create_request(cls.request_in, ObjectId(cls.user['_id'])).request_id
-        requests.edit_status_request(cls.request['_id'], cls.user_in_db)
-        registration(UserIn(email='admin@example.com', password='admin'), 'admin')
+        cls.request['_id'] = run(requests.create_request(cls.request_in, ObjectId(cls.user['_id']))).request_id
+        run(requests.edit_status_request(cls.request['_id'], cls.user_in_db))
+        run(registration(UserIn(email='admin@example.com', password='admin'), 'admin'))
 
 
     def teardown_class(cls):
         user_collection.delete_many({})
         request_collection.delete_many({})
+        notification_collection.delete_many({})
 
     @mock.patch("celery_app.send_email", mock.MagicMock(return_value=True))
     def test_send_email(self):
@@ -72,13 +85,220 @@ class TestCelery:
 
     @mock.patch("celery_app.warning_employee_long_time_complete_request", mock.MagicMock(return_value=True))
     def test_overdue_requests_execution(self):
-        requests.assign_employee_to_request(self.employee['_id'], self.request['_id'], self.admin_in_db)
+        run(requests.assign_employee_to_request(self.employee['_id'], self.request['_id'], self.admin_in_db))
         new_date = datetime.now() - timedelta(hours=72)
         request = request_collection.update_one({'_id': ObjectId(self.request['_id'])},
                                                 {'$set': {"date_receipt": new_date}}).modified_count
         result = celery_app.warning_employee_long_time_complete_request()
         assert result is True
 
+    @mock.patch.object(Config, 'NOTIFICATION_DIGEST', True)
+    @mock.patch.object(Config, 'NOTIFICATION_DIGEST_MAX_ITEMS', 2)
+    @mock.patch("celery_app.send_email")
+    def test_notify_overdue_digest(self, send_email):
+        overdue_requests = [{'_id': i, 'title': f'Title {i}', 'email': 'admin@example.com'} for i in range(3)]
+        overdue_requests.append({'_id': 3, 'title': 'Title 3', 'email': 'employee@example.com'})
+        celery_app.notify_overdue(overdue_requests, 'Overdue')
+        assert send_email.delay.call_count == 2
+        email, title, text = send_email.delay.call_args_list[0][0]
+        assert email == 'admin@example.com'
+        assert title == 'Overdue requests (3)'
+        assert text == 'Overdue (3):\nTitle 0 id = 0\nTitle 1 id = 1\n... and 1 more'
+
+    @mock.patch.object(Config, 'NOTIFICATION_DIGEST', False)
+    @mock.patch("celery_app.send_email")
+    def test_notify_overdue_per_request(self, send_email):
+        overdue_requests = [{'_id': i, 'title': f'Title {i}', 'email': 'admin@example.com'} for i in range(3)]
+        celery_app.notify_overdue(overdue_requests, 'Overdue')
+        assert send_email.delay.call_count == 3
+
+    def test_notification_ledger(self):
+        overdue_requests = [{'_id': ObjectId()}, {'_id': ObjectId()}]
+        record_notified(notification_collection, 'test', overdue_requests[:1], 1)
+        assert filter_not_notified(notification_collection, 'test', overdue_requests) == overdue_requests[1:]
+        assert filter_not_notified(notification_collection, 'other', overdue_requests) == overdue_requests
+        record_notified(notification_collection, 'test', overdue_requests[1:], -1)  # Already expired
+        assert filter_not_notified(notification_collection, 'test', overdue_requests) == overdue_requests[1:]
+
+
+class TestSMTPPool:
+
+    def setup_method(self):
+        self.connections = []
+
+        def factory(host, port):
+            smtp = mock.MagicMock()
+            smtp.noop.return_value = (250, b'OK')
+            self.connections.append(smtp)
+            return smtp
+
+        self.pool = SMTPPool('smtp.example.com', 587, 'user', 'password', size=1, max_messages=2,
+                             healthcheck_interval=0, factory=factory)
+
+    def test_reuse_connection(self):
+        self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        assert len(self.connections) == 1
+        assert self.connections[0].login.call_count == 1
+        assert self.connections[0].sendmail.call_count == 2
+
+    def test_max_messages(self):
+        for _ in range(3):
+            self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        assert len(self.connections) == 2
+        self.connections[0].quit.assert_called_once()
+
+    def test_reconnect_after_disconnect(self):
+        self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        self.connections[0].noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        assert len(self.connections) == 2
+        assert self.connections[1].sendmail.call_count == 1
+
+    def test_retry_failed_send(self):
+        self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        self.connections[0].sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.sendmail('from@example.com', 'to@example.com', 'message')
+        assert len(self.connections) == 2
+        assert self.connections[1].sendmail.call_count == 1
+
+
+@mock.patch.object(Config, 'TRACING', True)
+class TestTracing:
+
+    def setup_method(self):
+        self.exporter = mock.Mock()
+        self.patch = mock.patch.object(tracing, '_exporter', self.exporter)
+        self.patch.start()
+
+    def teardown_method(self):
+        self.patch.stop()
+
+    def exported(self) -> dict:
+        return {call[0][0].name: call[0][0] for call in self.exporter.export.call_args_list}
+
+    def test_traceparent(self):
+        span = tracing.Span('test')
+        assert tracing.parse_traceparent(tracing.format_traceparent(span)) == (span.trace_id, span.span_id)
+        assert tracing.parse_traceparent('invalid') == (None, None)
+
+    def test_task_propagation(self):
+        with tracing.span('POST /registration', tracing.SERVER) as server:
+            headers = {'id': 'task-id', 'task': 'celery_app.send_email'}
+            tracing.task_publishing(headers)
+            tracing.task_published(headers)
+            user_collection.find_one({'email': 'trace@example.com'})
+        task = mock.Mock(request=mock.Mock(traceparent=headers['traceparent']))
+        task.name = 'celery_app.send_email'
+        tracing.task_started(task, 'task-id')
+        tracing.task_finished('task-id', 'SUCCESS')
+        spans = self.exported()
+        publish = spans['celery.publish celery_app.send_email']
+        assert publish.parent_id == server.span_id
+        assert spans['mongodb.find'].parent_id == server.span_id
+        assert spans['celery.run celery_app.send_email'].trace_id == server.trace_id
+        assert spans['celery.run celery_app.send_email'].parent_id == publish.span_id
+        assert tracing.current_span.get() is None
+
+    @mock.patch.object(tracing, 'MAX_PUBLISH_SPANS', 2)
+    def test_publish_spans_bounded(self):
+        for task_id in ('task-1', 'task-2', 'task-3'):
+            tracing.task_publishing({'id': task_id, 'task': 'celery_app.send_email'})
+        assert list(tracing._publish_spans) == ['task-2', 'task-3']
+        tracing.task_publish_failed('task-2', ConnectionError('broker is down'))
+        tracing.task_published({'id': 'task-3'})
+        spans = [call[0][0] for call in self.exporter.export.call_args_list]
+        assert [finished.error for finished in spans] == ['The publication was not confirmed',
+                                                          'ConnectionError: broker is down', None]
+        assert not tracing._publish_spans
+
+    def test_file_exporter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exporter = tracing.FileExporter(os.path.join(directory, 'spans.jsonl'), interval=0.01)
+            finished = tracing.Span('test')
+            finished.end_time = finished.start_time
+            exporter.export(finished)
+            for _ in range(100):
+                if os.path.exists(exporter.path):
+                    break
+                time.sleep(0.01)
+            with open(exporter.path) as file:
+                assert [json.loads(line)['name'] for line in file] == ['test']
+
+
+class TestDeadlines:
+
+    def setup_method(self):
+        self.timer = DeadlineTimer(Config.REDIS_URL, key='test-deadlines')
+        self.patch = mock.patch.object(celery_app, 'deadline_timer', self.timer)
+        self.patch.start()
+
+    def teardown_method(self):
+        self.timer._sync_client().delete(self.timer.key)
+        self.patch.stop()
+        request_collection.delete_many({'title': 'Deadline Title'})
+        notification_collection.delete_many({})
+
+    def test_claim_due(self):
+        now = datetime.now()
+        self.timer.schedule_sync(CONSIDERATION, ['1', '2'], now - timedelta(minutes=1))
+        self.timer.schedule_sync(EXECUTION, ['3'], now + timedelta(minutes=1))
+        assert self.timer.claim_due(10, now) == {CONSIDERATION: ['1', '2']}
+        assert self.timer.claim_due(10, now) == {}
+        assert self.timer.claim_due(10, now + timedelta(minutes=2)) == {EXECUTION: ['3']}
+
+    def test_claim_due_limit(self):
+        self.timer.schedule_sync(CONSIDERATION, ['1', '2', '3'], datetime.now() - timedelta(minutes=1))
+        assert len(self.timer.claim_due(2)[CONSIDERATION]) == 2
+        assert len(self.timer.claim_due(2)[CONSIDERATION]) == 1
+
+    def test_reconcile(self):
+        now = datetime.now()
+        self.timer.schedule_sync(CONSIDERATION, ['1'], now + timedelta(hours=1))
+        assert self.timer.reconcile(CONSIDERATION, {'1': now, '2': now}) == 1
+        scores = dict(self.timer._sync_client().zrange(self.timer.key, 0, -1, withscores=True))
+        assert scores == {f'{CONSIDERATION}:1': (now + timedelta(hours=1)).timestamp(),
+                          f'{CONSIDERATION}:2': now.timestamp()}
+
+    def test_schedule_error(self):
+        errors = REGISTRY.get_sample_value('deadline_timer_errors_total', {'operation': 'schedule'}) or 0
+        timer = DeadlineTimer('redis://localhost:1')
+        with mock.patch('utils.deadlines.log') as log:
+            run(timer.schedule(CONSIDERATION, {'1': datetime.now()}))
+        assert timer.errors == 1
+        assert REGISTRY.get_sample_value('deadline_timer_errors_total', {'operation': 'schedule'}) == errors + 1
+        assert log.call_args[0][0] == 'deadline_timer_error'
+
+    @mock.patch.object(Config, 'DEADLINE_BATCH_SIZE', 1)
+    def test_schedule_existing_deadlines(self):
+        date_receipt = datetime.now()
+        waiting, assigned = ObjectId(), ObjectId()
+        self.timer.schedule_sync(EXECUTION, [str(assigned)], date_receipt)
+        found = [{'_id': waiting, 'employee_id': '', 'date_receipt': date_receipt},
+                 {'_id': assigned, 'employee_id': ObjectId(), 'date_receipt': date_receipt}]
+        with mock.patch.object(celery_app, 'request_collection', mock.Mock(find=mock.Mock(return_value=found))):
+            assert celery_app.schedule_existing_deadlines() == 1
+        scores = dict(self.timer._sync_client().zrange(self.timer.key, 0, -1, withscores=True))
+        assert scores == {f'{CONSIDERATION}:{waiting}': consideration_deadline(date_receipt).timestamp(),
+                          f'{EXECUTION}:{assigned}': date_receipt.timestamp()}
+
+    @mock.patch("celery_app.send_email")
+    def test_fire_due_deadlines(self, send_email):
+        if not user_collection.find_one({'role': 'admin'}):
+            user_collection.insert_one({'email': 'admin@example.com', 'role': 'admin'})
+        overdue = request_collection.insert_one({'title': 'Deadline Title', 'employee_id': '', 'status': None,
+                                                 'date_receipt': datetime.now() - timedelta(days=1)}).inserted_id
+        assigned = request_collection.insert_one({'title': 'Deadline Title', 'employee_id': ObjectId(),
+                                                  'status': 'active', 'date_receipt': datetime.now()}).inserted_id
+        self.timer.schedule_sync(CONSIDERATION, [str(overdue), str(assigned)], datetime.now() - timedelta(minutes=1))
+
+        assert celery_app.fire_due_deadlines() == 2
+        assert send_email.delay.call_count == 1
+        # Only the request still waiting for an employee is notified again later
+        next_deadlines = self.timer._sync_client().zrange(self.timer.key, 0, -1)
+        assert next_deadlines == [f'{CONSIDERATION}:{overdue}']
+        assert celery_app.fire_due_deadlines() == 0
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
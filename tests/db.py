@@ -1,18 +1,31 @@
+import asyncio
+import os
 import time
 import unittest
 from datetime import datetime
 
+import mock
 from bson import ObjectId
 from fastapi import HTTPException
+from motor.frameworks import asyncio as motor_framework
 
+from prometheus_client import REGISTRY
 from pytest import raises
 
+from config import Config
 from db import requests
 from models.requests import RequestIn, RequestOut, RequestOutAdmin, RequestOutEmployee
 from models.user import UserIn, UserOut, UserInDB
 from db.user import get_user, registration, login, get_employees
 from utils.auth import get_password_hash
-from utils.db import user_collection, request_collection
+from utils.db import (LazyDatabaseObject, db, get_motor_client, user_collection, user_collection_async,
+                      request_collection)
+from utils.indexes import INDEXES, ensure_indexes, check_indexes
+from utils.metrics import MONGODB_COMMAND_DURATION, MongoCommandMetrics, command_collection
+from utils.profiler import command_shape, current_profile, finish_profile, query_shape, start_profile
+from utils.pagination import encode_cursor
+from utils.request_cache import RequestCache, request_cache
+from tests.utils import run
 
 
 class TestService:
@@ -50,7 +63,7 @@ class TestService:
         cls.incorrect_user_id = '5e7c92cf6e66c5e9a8b9e005'
         cls.incorrect_request_id = '5e7c92cf6e66c5e9a8b9e005'
 
-        registration(UserIn(email='admin@example.com', password='admin'), 'admin')
+        run(registration(UserIn(email='admin@example.com', password='admin'), 'admin'))
 
     def teardown_class(cls):
         user_collection.delete_many({})
@@ -58,7 +71,7 @@ class TestService:
 
     def test_registration_user(self):
         role = 'user'
-        result = registration(self.new_user)
+        result = run(registration(self.new_user))
         TestService.user['_id'] = result.user_id
         TestService.user['hash_password'] = get_password_hash(self.user['password'])
         TestService.user['date_registration'] = TestService.user_in_db.date_registration = result.date_registration
@@ -67,11 +80,11 @@ class TestService:
 
     def test_registration_user_exists(self):
         with raises(HTTPException):
-            assert registration(self.new_user)
+            assert run(registration(self.new_user))
 
     def test_registration_admin(self):
         role = 'admin'
-        result = registration(self.new_admin, role=role)
+        result = run(registration(self.new_admin, role=role))
         TestService.admin['_id'] = result.user_id
         TestService.admin['hash_password'] = get_password_hash(self.admin['password'])
         TestService.admin['date_registration'] = result.date_registration
@@ -79,97 +92,118 @@ class TestService:
         assert result.role == role
 
     def test_get_user(self):
-        result = get_user(self.user['email'])
+        result = run(get_user(self.user['email']))
         assert type(result) is UserInDB
 
     def test_get_user_not_exists(self):
         email = 'not_exists@gmail.com'
-        result = get_user(email)
+        result = run(get_user(email))
         assert result is None
 
     def test_login(self):
-        result = login(self.user_in)
+        result = run(login(self.user_in))
         assert result['access_token'] is not None
 
     def test_login_user_doesnt_exists(self):
         with raises(HTTPException):
             user = UserIn(email='not_exists@gmail.com', password='password')
-            assert login(user)
+            assert run(login(user))
 
     def test_login_user_incorrect_data(self):
         with raises(HTTPException):
             user = self.user_in
             user.email = 'not_exit@gmail.com'
-            assert login(user)
+            assert run(login(user))
 
     def test_create_request(self):
-        result = requests.create_request(self.request_in, ObjectId(self.user['_id']))
+        result = run(requests.create_request(self.request_in, ObjectId(self.user['_id'])))
         TestService.request['_id'] = result.request_id
         TestService.request['status'] = result.status
         assert type(result) is RequestOut
 
     def test_get_requests(self):
         TestService.user_in_db._id = ObjectId(self.user['_id'])
-        result = requests.get_requests(self.user_in_db)
+        result = run(requests.get_requests(self.user_in_db))
         assert type(result) is list
 
+    def test_get_requests_pagination(self):
+        user = UserInDB(_id=ObjectId(), email='pages@example.com', hash_password=None, role='user',
+                        date_registration=None)
+        ids = [run(requests.create_request(self.request_in, user._id)).request_id for _ in range(3)]
+        first_page = run(requests.get_requests(user, limit=2))
+        assert [request.request_id for request in first_page] == ids[:2]
+        cursor = encode_cursor(first_page[-1].date_receipt, first_page[-1].request_id)
+        second_page = run(requests.get_requests(user, limit=2, cursor=cursor))
+        assert [request.request_id for request in second_page] == ids[2:]
+        request_collection.delete_many({'user_id': user._id})
+
+    def test_get_requests_invalid_cursor(self):
+        with raises(HTTPException):
+            assert run(requests.get_requests(self.user_in_db, limit=2, cursor='invalid'))
+
     def test_get_request(self):
-        result = requests.get_request(self.request['_id'], self.user_in_db)
+        result = run(requests.get_request(self.request['_id'], self.user_in_db))
         assert type(result) is RequestOut
 
     def test_get_request_doesnt_exists(self):
         with raises(HTTPException):
-            assert requests.get_request(self.incorrect_request_id, self.user_in_db)
+            assert run(requests.get_request(self.incorrect_request_id, self.user_in_db))
 
     def test_get_requests_incorrect_user_id(self):
         with raises(HTTPException):
             user = UserInDB(_id=self.incorrect_user_id, email=self.user['email'],
                             hash_password=self.user['hash_password'], role=self.user['role'],
                             date_registration=self.user['date_registration'])
-            assert requests.get_requests(user)
+            assert run(requests.get_requests(user))
 
     def test_edit_request(self):
-        result = requests.edit_request(self.request['_id'])
+        result = run(requests.edit_request(self.request['_id']))
         assert type(result) is RequestOut
-        result = requests.edit_request(self.request['_id'], title='Title')
+        result = run(requests.edit_request(self.request['_id'], title='Title'))
         assert result.title == 'Title'
-        result = requests.edit_request(self.request['_id'], description='Description')
+        result = run(requests.edit_request(self.request['_id'], description='Description'))
         assert result.description == 'Description'
 
     def test_edit_status_request_user(self):
-        result = requests.edit_status_request(self.request['_id'], self.user_in_db)
+        result = run(requests.edit_status_request(self.request['_id'], self.user_in_db))
         assert result.status == 'active'
 
     def test_edit_status_request_user_status_active(self):
         with raises(HTTPException):
-            assert requests.edit_status_request(self.request['_id'], self.user_in_db)
+            assert run(requests.edit_status_request(self.request['_id'], self.user_in_db))
+
+    def test_edit_status_request_invalid_role(self):
+        user = UserInDB(_id=ObjectId(), email='guest@example.com', hash_password=None, role='guest',
+                        date_registration=None)
+        with raises(HTTPException):
+            assert run(requests.edit_status_request(self.request['_id'], user))
 
     def test_edit_request_status_not_draft(self):
         with raises(HTTPException):
-            assert requests.edit_request(self.request['_id'], title='Title', description='Description')
+            assert run(requests.edit_request(self.request['_id'], title='Title', description='Description'))
 
     def test_edit_status_request_admin(self):
-        result = requests.edit_status_request(self.request['_id'], self.admin_in_db)
+        result = run(requests.edit_status_request(self.request['_id'], self.admin_in_db))
         assert result.status == 'in_progress'
 
     def test_edit_status_request_admin_status_in_progress(self):
-        result = requests.edit_status_request(self.request['_id'], self.admin_in_db)
+        result = run(requests.edit_status_request(self.request['_id'], self.admin_in_db))
         assert result.status == 'finished'
 
     def test_edit_status_request_admin_status_finished(self):
         with raises(HTTPException):
-            assert requests.edit_status_request(self.request['_id'], self.admin_in_db)
+            assert run(requests.edit_status_request(self.request['_id'], self.admin_in_db))
 
     def test_admin_get_employees_empty(self):
-        result = get_employees()
+        result = run(get_employees())
         assert len(result) == 0
 
     def test_create_employee(self):
         self.employee_in.email = 'employee1@realty.com'
-        registration(self.employee_in, self.employee['role'])
+        run(registration(self.employee_in, self.employee['role']))
         time.sleep(1)
         self.employee_in.email = self.employee['email']
-        result = registration(self.employee_in, self.employee['role'])
+        result = run(registration(self.employee_in, self.employee['role']))
         TestService.employee['_id'] = result.user_id
         TestService.employee_in_db._id = ObjectId(result.user_id)
         TestService.employee['hash_password'] = get_password_hash(self.user['password'])
@@ -179,43 +213,198 @@ class TestService:
         assert result.role == self.employee['role']
 
     def test_admin_get_employees(self):
-        result = get_employees()
+        result = run(get_employees())
         assert type(result[0]) is UserOut
         assert result[0].user_id == self.employee['_id']
 
     def test_assign_employee_to_request_not_active(self):
         with raises(HTTPException):
-            assert requests.assign_employee_to_request(self.employee['_id'], self.request['_id'], self.admin_in_db)
+            assert run(requests.assign_employee_to_request(self.employee['_id'], self.request['_id'], self.admin_in_db))
 
     def test_assign_employee_to_request(self):
-        TestService.request['_id'] = requests.create_request(self.request_in, self.user_in_db._id).request_id
-        requests.edit_status_request(self.request['_id'], self.user_in_db)
-        result = requests.assign_employee_to_request(self.employee['_id'], self.request['_id'], self.admin_in_db)
+        TestService.request['_id'] = run(requests.create_request(self.request_in, self.user_in_db._id)).request_id
+        run(requests.edit_status_request(self.request['_id'], self.user_in_db))
+        result = run(requests.assign_employee_to_request(self.employee['_id'], self.request['_id'], self.admin_in_db))
         assert result == RequestOutAdmin(request_id=self.request['_id'], user_id=result.user_id,
                                          employee_id=self.employee['_id'], title=self.request['title'],
                                          description=self.request['description'], status='active',
                                          date_receipt=self.request['date_receipt'])
 
     def test_employee_get_requests(self):
-        result = requests.get_requests(self.employee_in_db)
+        result = run(requests.get_requests(self.employee_in_db))
         assert len(result) == 1
         assert result[0] == RequestOutEmployee(request_id=self.request['_id'], user_id=self.user['_id'],
                                                title=self.request['title'], description=self.request['description'],
                                                status='active', date_receipt=self.request['date_receipt'])
 
     def test_employee_get_request(self):
-        result = requests.get_request(self.request['_id'], self.employee_in_db)
+        result = run(requests.get_request(self.request['_id'], self.employee_in_db))
         assert result == RequestOutEmployee(request_id=self.request['_id'], user_id=self.user['_id'],
                                             title=self.request['title'], description=self.request['description'],
                                             status='active', date_receipt=self.request['date_receipt'])
 
     def test_employee_edit_status_request(self):
-        result = requests.edit_status_request(self.request['_id'], self.employee_in_db)
+        result = run(requests.edit_status_request(self.request['_id'], self.employee_in_db))
         assert result.status == 'in_progress'
-        result = requests.edit_status_request(self.request['_id'], self.employee_in_db)
+        result = run(requests.edit_status_request(self.request['_id'], self.employee_in_db))
         assert result.status == 'finished'
         with raises(HTTPException):
-            assert requests.edit_status_request(self.request['_id'], self.employee_in_db)
+            assert run(requests.edit_status_request(self.request['_id'], self.employee_in_db))
+
+
+@mock.patch.object(Config, 'REQUEST_CACHE', True)
+class TestRequestCache:
+
+    def setup_class(cls):
+        cls.user = UserInDB(_id=ObjectId(), email='cache@example.com', hash_password=None, role='user',
+                            date_registration=None)
+        cls.request_in = RequestIn(title='Test Title', description='Test Description',
+                                   date_receipt=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    def teardown_class(cls):
+        request_collection.delete_many({'user_id': cls.user._id})
+        run(request_cache.close())
+
+    def test_get_request_cached(self):
+        request_id = run(requests.create_request(self.request_in, self.user._id)).request_id
+        hits = request_cache.hits
+        result = run(requests.get_request(request_id, self.user))
+        assert result.title == self.request_in.title
+        assert request_cache.hits == hits + 1
+
+    def test_get_request_cached_other_user(self):
+        request_id = run(requests.create_request(self.request_in, self.user._id)).request_id
+        other = UserInDB(_id=ObjectId(), email='other@example.com', hash_password=None, role='user',
+                         date_registration=None)
+        with raises(HTTPException):
+            assert run(requests.get_request(request_id, other))
+
+    def test_edit_request_updates_cache(self):
+        request_id = run(requests.create_request(self.request_in, self.user._id)).request_id
+        run(requests.get_request(request_id, self.user))
+        run(requests.edit_request(request_id, title='New Title'))
+        hits = request_cache.hits
+        result = run(requests.get_request(request_id, self.user))
+        assert result.title == 'New Title'
+        assert request_cache.hits == hits + 1
+
+    def test_stale_reader(self):
+        request_id = run(requests.create_request(self.request_in, self.user._id)).request_id
+        stale = request_collection.find_one({'_id': ObjectId(request_id)})  # Read by a reader missing the cache
+        run(requests.edit_request(request_id, title='New Title'))
+        run(request_cache.set(stale))  # The reader puts back the document it read before the change
+        assert run(requests.get_request(request_id, self.user)).title == 'New Title'
+
+    def test_set_keeps_newer_version(self):
+        request_id = ObjectId()
+        run(request_cache.set({'_id': request_id, 'version': 2, 'title': 'New Title'}))
+        run(request_cache.set({'_id': request_id, 'version': 1, 'title': 'Old Title'}))
+        assert run(request_cache.get(str(request_id)))['title'] == 'New Title'
+        run(request_cache.set({'_id': request_id, 'version': 3, 'title': 'Newer Title'}))
+        assert run(request_cache.get(str(request_id)))['title'] == 'Newer Title'
+        run(request_cache.invalidate(request_id))
+
+    def test_metrics(self):
+        misses = REGISTRY.get_sample_value('request_cache_lookups_total', {'result': 'miss'}) or 0
+        assert run(request_cache.get(str(ObjectId()))) is None
+        assert REGISTRY.get_sample_value('request_cache_lookups_total', {'result': 'miss'}) == misses + 1
+
+    def test_metrics_errors(self):
+        cache = RequestCache('redis://localhost:1', ttl=1)
+        errors = REGISTRY.get_sample_value('request_cache_errors_total', {'operation': 'get'}) or 0
+        assert run(cache.get(str(ObjectId()))) is None
+        assert cache.stats()['errors'] == 1
+        assert REGISTRY.get_sample_value('request_cache_errors_total', {'operation': 'get'}) == errors + 1
+
+
+class TestIndexes:
+
+    def test_ensure_indexes(self):
+        result = ensure_indexes(db)
+        assert len(result) == sum(len(indexes) for indexes in INDEXES.values())
+
+    def test_check_indexes(self):
+        ensure_indexes(db)
+        report = check_indexes(db)
+        assert report['user']['missing'] == []
+        assert report['request']['missing'] == []
+
+
+class TestMongoCommandMetrics:
+
+    def test_command_collection(self):
+        assert command_collection('find', {'find': 'request', 'filter': {}}) == 'request'
+        assert command_collection('getMore', {'getMore': 1, 'collection': 'request'}) == 'request'
+        assert command_collection('ismaster', {'ismaster': 1}) == ''
+
+    def test_listener(self):
+        listener = MongoCommandMetrics()
+        started = mock.Mock(command_name='find', command={'find': 'user'}, connection_id=('db', 1), request_id=7)
+        succeeded = mock.Mock(command_name='find', connection_id=('db', 1), request_id=7, duration_micros=1500)
+        before = MONGODB_COMMAND_DURATION.labels('user', 'find')._sum.get()
+        listener.started(started)
+        listener.succeeded(succeeded)
+        assert abs(MONGODB_COMMAND_DURATION.labels('user', 'find')._sum.get() - before - 0.0015) < 1e-9
+        assert listener._collections == {}
+
+
+class TestProfiler:
+
+    def test_query_shape(self):
+        assert query_shape({'_id': ObjectId(), 'status': {'$in': ['active', 'draft']}}) == \
+            {'_id': '?', 'status': {'$in': '?'}}
+        assert command_shape('update', {'updates': [{'q': {'_id': 1}, 'u': {'$set': {'status': 'active'}}}]}) == \
+            {'_id': '?'}
+        assert command_shape('insert', {'documents': [{'title': 'Title'}]}) is None
+
+    def test_profile(self):
+        with mock.patch.object(Config, 'QUERY_BUDGET', 1):
+            profile, token = start_profile('task', 'test')
+            user_collection.find_one({'email': 'profile@example.com'})
+            user_collection.find_one({'email': 'other@example.com'})
+            summary = finish_profile(profile, token)
+        assert summary['queries'] == 2
+        assert summary['over_budget']
+        assert summary['repeated'] == [{'collection': 'user', 'command': 'find', 'shape': {'email': '?'}, 'count': 2}]
+        user_collection.find_one({'email': 'profile@example.com'})
+        assert profile.commands == summary['commands'] and len(profile.commands) == 2
+
+    def test_profile_motor(self):
+        profile, token = start_profile('http', 'test')
+        run(user_collection_async.find_one({'email': 'profile@example.com'}))
+        summary = finish_profile(profile, token)
+        assert summary['queries'] == 1
+        assert summary['commands'][0]['collection'] == 'user'
+
+    def test_motor_caller_context(self):
+        get_motor_client()
+        profile, token = start_profile('http', 'test')
+        try:
+            assert run(motor_framework.run_on_executor(asyncio.get_event_loop(), current_profile.get)) is profile
+        finally:
+            finish_profile(profile, token)
+
+
+
+class TestLazyDatabaseObject:
+
+    def test_resolved_once(self):
+        resolve = mock.Mock(side_effect=lambda: mock.Mock())
+        proxy = LazyDatabaseObject(resolve)
+        assert proxy.name is proxy.name
+        assert resolve.call_count == 1
+
+    def test_resolved_after_fork_and_close(self):
+        resolve = mock.Mock(side_effect=lambda: mock.Mock())
+        proxy = LazyDatabaseObject(resolve)
+        collection = proxy._get()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if proxy._get() is not collection else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert proxy._get() is collection
+        with mock.patch('utils.db._generation', -1):
+            assert proxy._get() is not collection
 
 
 if __name__ == '__main__':
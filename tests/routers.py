@@ -1,14 +1,23 @@
+import csv
+import json
 import time
 import unittest
 from datetime import datetime
 
+from bson import ObjectId
+import mock
 from fastapi.testclient import TestClient
 
 from app import app
+from config import Config
 
 from db.user import get_user, registration
 from models.user import UserIn
+from utils import tracing
 from utils.db import user_collection, request_collection
+from utils.deadlines import CONSIDERATION, EXECUTION, consideration_deadline, deadline_timer
+from utils.importtime import import_times
+from tests.utils import run
 
 client = TestClient(app)
 
@@ -24,16 +33,18 @@ class TestRoutes:
         cls.request = {'title': 'Test Title', 'description': 'Test Description',
                        'date_receipt': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
         cls.request_id = None
+        cls.bulk_request_ids = []
         cls.jwt = {'user': None, 'admin': None, 'employee': None}
-        registration(UserIn(email='admin@example.com', password='admin'), 'admin')
+        run(registration(UserIn(email='admin@example.com', password='admin'), 'admin'))
 
     def teardown_class(cls):
         user_collection.delete_many({})
         request_collection.delete_many({})
+        deadline_timer._sync_client().delete(deadline_timer.key)
 
     def test_registration_user(self):
         response = client.post('/registration', json=self.user,)
-        TestRoutes.user_id = get_user(self.user['email'])._id
+        TestRoutes.user_id = run(get_user(self.user['email']))._id
         assert response.status_code == 201
         assert response.json() == {"user_id": str(self.user_id),
                                    "email": self.user['email'],
@@ -285,7 +296,8 @@ class TestRoutes:
                  "description": self.request['description'],
                  "status": "draft",
                  "date_receipt": self.request['date_receipt']}
-            ]
+            ],
+            'next_cursor': None
         }
 
     def test_get_requests_user_empty(self):
@@ -325,7 +337,8 @@ class TestRoutes:
                  "employee_id": "",
                  "status": "active",
                  "date_receipt": self.request['date_receipt']}
-            ]
+            ],
+            'next_cursor': None
         }
 
     def test_get_request_user(self):
@@ -356,6 +369,76 @@ class TestRoutes:
                             "status": "active",
                             "date_receipt": self.request['date_receipt']}
 
+    def test_get_requests_fields(self):
+        headers = {'jwt': self.jwt['admin']}
+        response = client.get('/requests?fields=title,status', headers=headers)
+        assert response.status_code == 200
+        request = response.json()['requests'][0]
+        assert request == {'request_id': self.request_id, 'title': self.request['title'], 'status': 'active',
+                           'date_receipt': request['date_receipt']}
+
+    def test_get_requests_compact(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.get('/requests?view=compact', headers=headers)
+        assert response.status_code == 200
+        assert 'description' not in response.json()['requests'][0]
+
+    def test_get_requests_unknown_fields(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.get('/requests?fields=title,employee_id', headers=headers)
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'Unknown fields: employee_id'}
+
+    def test_get_request_fields(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.get(f'/requests/{self.request_id}?fields=status', headers=headers)
+        assert response.status_code == 200
+        assert response.json() == {'request_id': self.request_id, 'status': 'active',
+                                   'date_receipt': response.json()['date_receipt']}
+
+    def test_export_requests_ndjson(self):
+        headers = {'jwt': self.jwt['admin']}
+        response = client.get('/requests/export', headers=headers)
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row['request_id'] for row in rows] == [self.request_id]
+        assert rows[0]['status'] == 'active'
+
+    def test_export_requests_csv(self):
+        headers = {'jwt': self.jwt['admin']}
+        response = client.get('/requests/export?format=csv&batch_size=1', headers=headers)
+        assert response.status_code == 200
+        rows = list(csv.DictReader(response.text.splitlines()))
+        assert [row['request_id'] for row in rows] == [self.request_id]
+        assert rows[0]['employee_id'] == ''
+
+    def test_export_requests_user(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.get('/requests/export', headers=headers)
+        assert response.status_code == 403
+        assert response.json() == {"detail": "No access rights"}
+
+    def test_get_request_not_modified(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.get(f"/requests/{self.request_id}", headers=headers)
+        etag = response.headers['etag']
+        headers['If-None-Match'] = etag
+        response = client.get(f"/requests/{self.request_id}", headers=headers)
+        assert response.status_code == 304
+        assert response.headers['etag'] == etag
+        assert response.content == b''
+
+    def test_get_requests_not_modified(self):
+        headers = {'jwt': self.jwt['admin']}
+        etag = client.get('/requests', headers=headers).headers['etag']
+        headers['If-None-Match'] = f'W/"other", {etag}'
+        response = client.get('/requests', headers=headers)
+        assert response.status_code == 304
+        response = client.get('/requests?view=compact', headers=headers)
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+
     def test_get_request_user_not_exist(self):
         request_id = '5e7bfee773467953a87e467a'
         headers = {'jwt': self.jwt['user']}
@@ -441,6 +524,16 @@ class TestRoutes:
                             "status": "active",
                             "date_receipt": self.request['date_receipt']}
 
+    def test_edit_status_request_changes_etag(self):
+        headers = {'jwt': self.jwt['admin']}
+        etag = client.get(f"/requests/{self.request_id}", headers=headers).headers['etag']
+        client.patch(f"/requests/status/{self.request_id}", headers=headers)
+        headers['If-None-Match'] = etag
+        response = client.get(f"/requests/{self.request_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()['status'] == 'in_progress'
+        assert response.headers['etag'] != etag
+
     def test_edit_status_request_active_again(self):
         headers = {'jwt': self.jwt['user']}
         response = client.patch(f"/requests/status/{self.request_id}", headers=headers)
@@ -486,7 +579,7 @@ class TestRoutes:
     def test_registration_employee(self):
         headers = {'jwt': self.jwt['admin']}
         response = client.post('/employee', json=self.employee, headers=headers)
-        TestRoutes.employee_id = get_user(self.employee['email'])._id
+        TestRoutes.employee_id = run(get_user(self.employee['email']))._id
         assert response.status_code == 201
         assert response.json() == {"user_id": response.json()['user_id'],
                                    "email": self.employee['email'],
@@ -545,7 +638,8 @@ class TestRoutes:
             'request_id': response['requests'][0]['request_id'],
             'status': response['requests'][0]['status'],
             'title': self.request['title'],
-            'user_id': response['requests'][0]['user_id']}]}
+            'user_id': response['requests'][0]['user_id']}],
+            'next_cursor': None}
 
     def test_employee_get_request(self):
         headers = {'jwt': self.jwt['employee']}
@@ -560,6 +654,171 @@ class TestRoutes:
             'title': self.request['title'],
             'user_id': response['user_id']}
 
+    def test_create_requests_bulk(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.post('/requests/bulk', json=[self.request, self.request], headers=headers)
+        assert response.status_code == 201
+        results = response.json()['results']
+        assert [result['index'] for result in results] == [0, 1]
+        assert all(result['request_id'] and result['error'] is None for result in results)
+        TestRoutes.bulk_request_ids = [result['request_id'] for result in results]
+
+    def test_assign_employees_bulk(self):
+        headers = {'jwt': self.jwt['user']}
+        client.patch(f'/requests/status/{self.bulk_request_ids[0]}', headers=headers)
+        headers['jwt'] = self.jwt['admin']
+        response = client.patch('/employee/assign/bulk', headers=headers, json=[
+            {'employee_id': str(self.employee_id), 'request_id': self.bulk_request_ids[0]},
+            {'employee_id': str(self.employee_id), 'request_id': self.bulk_request_ids[1]},
+            {'employee_id': 'invalid', 'request_id': self.bulk_request_ids[0]}])
+        assert response.status_code == 200
+        assert response.json() == {'results': [
+            {'index': 0, 'request_id': self.bulk_request_ids[0], 'error': None},
+            {'index': 1, 'request_id': self.bulk_request_ids[1],
+             'error': f'This request ({self.bulk_request_ids[1]}) does not have the active status'},
+            {'index': 2, 'request_id': self.bulk_request_ids[0], 'error': 'Invalid id'}]}
+
+    def test_create_requests_bulk_empty(self):
+        response = client.post('/requests/bulk', json=[], headers={'jwt': self.jwt['user']})
+        assert response.status_code == 201
+        assert response.json() == {'results': []}
+
+    def test_bulk_too_many_items(self):
+        # The items are not validated, the length of the list is checked first
+        items = [{}] * (Config.BULK_MAX_ITEMS + 1)
+        response = client.post('/requests/bulk', json=items, headers={'jwt': self.jwt['user']})
+        assert response.status_code == 422
+        assert [error['type'] for error in response.json()['detail']] == ['value_error.list.max_items']
+        response = client.patch('/employee/assign/bulk', json=items, headers={'jwt': self.jwt['admin']})
+        assert response.status_code == 422
+        assert [error['type'] for error in response.json()['detail']] == ['value_error.list.max_items']
+
+    def test_assign_employees_bulk_duplicate(self):
+        headers = {'jwt': self.jwt['user']}
+        client.patch(f'/requests/status/{self.bulk_request_ids[1]}', headers=headers)
+        headers['jwt'] = self.jwt['admin']
+        response = client.patch('/employee/assign/bulk', headers=headers, json=[
+            {'employee_id': str(self.employee_id), 'request_id': self.bulk_request_ids[1]},
+            {'employee_id': str(self.employee_id), 'request_id': self.bulk_request_ids[1]}])
+        assert response.status_code == 200
+        error = f'This request ({self.bulk_request_ids[1]}) is assigned more than once'
+        assert response.json() == {'results': [
+            {'index': 0, 'request_id': self.bulk_request_ids[1], 'error': error},
+            {'index': 1, 'request_id': self.bulk_request_ids[1], 'error': error}]}
+        assert request_collection.find_one({'_id': ObjectId(self.bulk_request_ids[1])})['employee_id'] == ''
+
+    def test_assign_employees_bulk_user(self):
+        headers = {'jwt': self.jwt['user']}
+        response = client.patch('/employee/assign/bulk', headers=headers, json=[])
+        assert response.status_code == 403
+
+    def test_fast_responses(self):
+        user, admin, employee = ({'jwt': self.jwt[role]} for role in ('user', 'admin', 'employee'))
+        with mock.patch.object(Config, 'FAST_RESPONSES', True):
+            response = client.post('/requests', json=self.request, headers=user)
+            assert response.status_code == 201
+            request_id = response.json()['request_id']
+            assert client.patch(f'/requests/{request_id}', headers=user,
+                                params={'title': 'Fast Title'}).json()['title'] == 'Fast Title'
+            assert client.patch(f'/requests/status/{request_id}', headers=user).json()['status'] == 'active'
+            response = client.patch(f'/employee/assign?employee_id={self.employee_id}&request_id={request_id}',
+                                    headers=admin)
+            assert response.status_code == 200
+            assert response.json()['employee_id'] == str(self.employee_id)
+            assert client.patch(f'/requests/status/{request_id}', headers=employee).json()['status'] == 'in_progress'
+            assert client.post('/requests/bulk', json=[self.request], headers=user).status_code == 201
+            reads = [('/requests', user), ('/requests', admin), ('/requests', employee),
+                     (f'/requests/{request_id}', admin), ('/requests?fields=title,status', admin), ('/employee', admin)]
+            fast = [client.get(url, headers=headers) for url, headers in reads]
+        assert all(response.status_code == 200 for response in fast)
+        default = [client.get(url, headers=headers) for url, headers in reads]
+        assert [response.json() for response in fast] == [response.json() for response in default]
+
+    @staticmethod
+    def deadlines(request_id: str) -> dict:
+        redis = deadline_timer._sync_client()
+        scores = {alert: redis.zscore(deadline_timer.key, f'{alert}:{request_id}')
+                  for alert in (CONSIDERATION, EXECUTION)}
+        return {alert: score for alert, score in scores.items() if score is not None}
+
+    def test_deadlines(self):
+        user, admin, employee = ({'jwt': self.jwt[role]} for role in ('user', 'admin', 'employee'))
+        request_id = client.post('/requests', json=self.request, headers=user).json()['request_id']
+        date_receipt = datetime.strptime(self.request['date_receipt'], "%Y-%m-%d %H:%M:%S")
+        assert self.deadlines(request_id) == {CONSIDERATION: consideration_deadline(date_receipt).timestamp()}
+        client.patch(f'/requests/status/{request_id}', headers=user)
+        assert list(self.deadlines(request_id)) == [CONSIDERATION]
+        client.patch(f'/employee/assign?employee_id={self.employee_id}&request_id={request_id}', headers=admin)
+        assert list(self.deadlines(request_id)) == [EXECUTION]
+        assert client.patch(f'/requests/status/{request_id}', headers=employee).json()['status'] == 'in_progress'
+        assert list(self.deadlines(request_id)) == [EXECUTION]
+        assert client.patch(f'/requests/status/{request_id}', headers=employee).json()['status'] == 'finished'
+        assert self.deadlines(request_id) == {}
+
+    def test_deadlines_bulk(self):
+        user, admin = {'jwt': self.jwt['user']}, {'jwt': self.jwt['admin']}
+        results = client.post('/requests/bulk', json=[self.request, self.request], headers=user).json()['results']
+        active_id, draft_id = (result['request_id'] for result in results)
+        assert list(self.deadlines(active_id)) == list(self.deadlines(draft_id)) == [CONSIDERATION]
+        client.patch(f'/requests/status/{active_id}', headers=user)
+        response = client.patch('/employee/assign/bulk', headers=admin, json=[
+            {'employee_id': str(self.employee_id), 'request_id': active_id},
+            {'employee_id': str(self.employee_id), 'request_id': draft_id}])
+        assert [result['error'] is None for result in response.json()['results']] == [True, False]
+        # Only the applied assignment moves the request to the execution deadline
+        assert list(self.deadlines(active_id)) == [EXECUTION]
+        assert list(self.deadlines(draft_id)) == [CONSIDERATION]
+
+    def test_metrics(self):
+        client.get(f'/requests/{self.request_id}', headers={'jwt': self.jwt['user']})
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert 'http_requests_total{method="GET",route="/requests/{request_id}",status="200"}' in response.text
+        assert 'mongodb_command_duration_seconds_count{collection="request",command="find"}' in response.text
+
+    def test_debug_profiler(self):
+        with mock.patch.object(Config, 'PROFILER', True):
+            client.get(f'/requests/{self.request_id}', headers={'jwt': self.jwt['admin']})
+            response = client.get('/debug/profiler', headers={'jwt': self.jwt['admin']})
+        assert response.status_code == 200
+        profile = [profile for profile in response.json()['profiles']
+                   if profile['name'] == 'GET /requests/{request_id}'][-1]
+        assert profile['queries'] >= 1
+        assert profile['commands'][0]['collection'] in ('user', 'request')
+
+    def test_tracing_registration(self):
+        exporter = mock.Mock()
+        with mock.patch.object(Config, 'TRACING', True), mock.patch.object(tracing, '_exporter', exporter):
+            response = client.post('/registration', json={'email': 'traced@realty.ru', 'password': 'traced'})
+        assert response.status_code == 201
+        spans = [call[0][0] for call in exporter.export.call_args_list]
+        server = [span for span in spans if span.name == 'POST /registration'][0]
+        insert = [span for span in spans if span.name == 'mongodb.insert'][0]
+        assert insert.trace_id == server.trace_id
+        assert insert.parent_id == server.span_id
+        assert insert.attributes['db.mongodb.collection'] == 'user'
+
+    def test_debug_profiler_disabled(self):
+        response = client.get('/debug/profiler', headers={'jwt': self.jwt['admin']})
+        assert response.status_code == 404
+        response = client.get('/debug/profiler', headers={'jwt': self.jwt['user']})
+        assert response.status_code == 403
+
+
+class TestImports:
+
+    def test_app_import(self):
+        entries = import_times('app')
+        names = {entry[0] for entry in entries}
+        assert 'celery_app' not in names
+        assert 'motor' not in names
+
+    def test_celery_app_import(self):
+        names = {entry[0] for entry in import_times('celery_app')}
+        assert 'fastapi' not in names
+        assert 'pydantic' not in names
+        assert 'starlette' not in names
+
 
 if __name__ == '__main__':
     unittest.main()
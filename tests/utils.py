@@ -0,0 +1,10 @@
+import asyncio
+
+
+def run(coroutine):
+    """Run a coroutine of the async data layer to completion
+
+    :param coroutine: awaitable returned by an async db/auth function
+    :return: result of the coroutine
+    """
+    return asyncio.get_event_loop().run_until_complete(coroutine)
@@ -1,14 +1,19 @@
 from datetime import timedelta, datetime
 
 import jwt
+from bson import ObjectId
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 
 from config import Config
+from utils.pool import BoundedProcessPool
+from utils.tracing import span
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
+# bcrypt takes ~100 ms of CPU, it runs outside of the event loop
+password_pool = BoundedProcessPool(Config.PASSWORD_HASH_WORKERS, Config.PASSWORD_HASH_MAX_PENDING, name='password')
 
 
 def verify_password(plain_password, hashed_password):
@@ -19,6 +24,16 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+async def verify_password_async(plain_password, hashed_password):
+    with span('bcrypt.verify'):
+        return await password_pool.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    with span('bcrypt.hash'):
+        return await password_pool.run(get_password_hash, password)
+
+
 def create_access_token(*, data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
@@ -31,10 +46,11 @@ def create_access_token(*, data: dict, expires_delta: timedelta = None):
 
 
 from models.user import TokenData, UserInDB
-from db.user import get_user
+from db.user import get_user, get_token_version
+from utils.cache import user_cache
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -48,7 +64,16 @@ def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInDB:
         token_data = TokenData(email=email)
     except jwt.PyJWTError:
         raise credentials_exception
-    user = get_user(token_data.email)
+    if Config.AUTH_TOKEN_CLAIMS and 'uid' in payload:
+        # The user is built from the signed claims, only the token version is checked
+        if payload.get('ver') != await get_token_version(token_data.email):
+            raise credentials_exception
+        return UserInDB(_id=ObjectId(payload['uid']), email=token_data.email, hash_password=None,
+                        role=payload.get('role'), date_registration=None)
+    user = user_cache.get(token_data.email)
     if user is None:
-        raise credentials_exception
+        user = await get_user(token_data.email)
+        if user is None:
+            raise credentials_exception
+        user_cache.set(token_data.email, user)
     return user
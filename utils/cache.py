@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+
+from config import Config
+from utils.metrics import CACHE_LOOKUPS
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after ttl seconds
+
+    The hits and misses of a named cache are also exported as Prometheus metrics (see utils.metrics).
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer=time.monotonic, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._hit_counter = CACHE_LOOKUPS.labels(name, 'hit') if name else None
+        self._miss_counter = CACHE_LOOKUPS.labels(name, 'miss') if name else None
+
+    def get(self, key):
+        """Get a value by key
+
+        :param key: key of the entry
+        :return: the value or None if there is no entry or it has expired
+        """
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > self.timer():
+                self._data.move_to_end(key)
+                self.hits += 1
+                if self._hit_counter is not None:
+                    self._hit_counter.inc()
+                return value
+            del self._data[key]
+        self.misses += 1
+        if self._miss_counter is not None:
+            self._miss_counter.inc()
+        return None
+
+    def set(self, key, value):
+        """Add or replace an entry, evicting the least recently used one when the cache is full
+
+        :param key: key of the entry
+        :param value: value of the entry
+        """
+        self._data[key] = (value, self.timer() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove an entry if it exists
+
+        :param key: key of the entry
+        """
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """Get the counters of the cache
+
+        :return: dictionary with size, hits and misses
+        """
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+# UserInDB by email, filled by utils.auth.get_current_user
+user_cache = TTLCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL, name='user')
+
+# Current token version by email, used by the token claims mode of utils.auth.get_current_user
+token_version_cache = TTLCache(Config.USER_CACHE_SIZE, Config.TOKEN_VERSION_CACHE_TTL, name='token_version')
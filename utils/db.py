@@ -1,8 +1,111 @@
+"""MongoDB clients of the process, created on first use
+
+The API opens its client on startup (see app.create_app), the celery worker and the test suite on the first query.
+A process forked after the creation of a client creates its own one, pymongo clients are not fork-safe.
+"""
+import contextvars
+import os
+
 from pymongo import MongoClient
 
 from config import Config
+from utils.metrics import mongo_command_metrics
+from utils.profiler import mongo_profiler
+from utils.tracing import mongo_tracer
+
+EVENT_LISTENERS = [mongo_command_metrics, mongo_profiler, mongo_tracer]
+
+# Clients by (kind, pid)
+_clients = {}
+# Incremented by close_clients and in a forked child, the proxies drop the objects of the previous clients
+_generation = 0
+
+
+def _new_generation():
+    global _generation
+    _generation += 1
+
+
+os.register_at_fork(after_in_child=_new_generation)
+
+
+def _client(kind: str, factory):
+    key = (kind, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = factory()
+    return client
+
+
+def get_client() -> MongoClient:
+    """Get the synchronous client, used by the celery worker and the test suite"""
+    return _client('mongo', lambda: MongoClient(Config.URL_MONGODB, event_listeners=EVENT_LISTENERS))
+
+
+def run_motor_in_caller_context():
+    """Run the commands of motor in the context of the coroutine issuing them
+
+    motor runs the pymongo calls in its thread pool without the context variables of the caller,
+    the command listeners need them to attribute a command to its HTTP request (utils.profiler, utils.tracing).
+    """
+    from motor.frameworks import asyncio as framework
+    run_on_executor = framework.run_on_executor
+    if getattr(run_on_executor, 'in_caller_context', False):
+        return
+
+    def run_in_caller_context(loop, fn, *args, **kwargs):
+        return run_on_executor(loop, contextvars.copy_context().run, fn, *args, **kwargs)
+
+    run_in_caller_context.in_caller_context = True
+    framework.run_on_executor = run_in_caller_context
+
+
+def get_motor_client():
+    """Get the asynchronous client, used by the API so Mongo round trips don't block the event loop"""
+    from motor.motor_asyncio import AsyncIOMotorClient
+    run_motor_in_caller_context()
+    return _client('motor', lambda: AsyncIOMotorClient(Config.URL_MONGODB, event_listeners=EVENT_LISTENERS))
+
+
+def close_clients():
+    """Close the clients created by the current process"""
+    _new_generation()
+    for key in [key for key in _clients if key[1] == os.getpid()]:
+        _clients.pop(key).close()
+
+
+class LazyDatabaseObject:
+    """Proxy of a database or a collection, the client is created on the first access
+
+    The resolved object is kept until the process forks or the clients are closed.
+    """
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+        self._obj = None
+        self._generation = None
+
+    def _get(self):
+        if self._generation != _generation:
+            self._obj = self._resolve()
+            self._generation = _generation
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __getitem__(self, name):
+        return self._get()[name]
+
+    def __repr__(self):
+        return f'LazyDatabaseObject({self._get()!r})'
+
+
+db = LazyDatabaseObject(lambda: get_client()[Config.DATABASE])
+user_collection = LazyDatabaseObject(lambda: get_client()[Config.DATABASE]['user'])
+request_collection = LazyDatabaseObject(lambda: get_client()[Config.DATABASE]['request'])
+notification_collection = LazyDatabaseObject(lambda: get_client()[Config.DATABASE]['notification'])
 
-client_mongo = MongoClient(Config.URL_MONGODB)
-db = client_mongo[Config.DATABASE]
-user_collection = db['user']
-request_collection = db['request']
\ No newline at end of file
+db_async = LazyDatabaseObject(lambda: get_motor_client()[Config.DATABASE])
+user_collection_async = LazyDatabaseObject(lambda: get_motor_client()[Config.DATABASE]['user'])
+request_collection_async = LazyDatabaseObject(lambda: get_motor_client()[Config.DATABASE]['request'])
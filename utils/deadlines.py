@@ -0,0 +1,155 @@
+"""Deadlines of the requests in a Redis sorted set
+
+A member is '<alert>:<request id>' scored with the timestamp of its deadline:
+consideration (no employee assigned) and execution (not finished). The API schedules and cancels the
+deadlines when a request is created, activated, assigned or finished, the celery task fire_due_deadlines
+claims the due ones every DEADLINE_TIMER_INTERVAL seconds, so only the requests crossing a deadline are read.
+A deadline lost to a Redis error of the API is scheduled again by schedule_existing_deadlines every
+DEADLINE_RECONCILE_INTERVAL seconds.
+"""
+import os
+from datetime import datetime, timedelta
+
+from config import Config
+from utils.metrics import DEADLINE_TIMER_ERRORS
+from utils.profiler import log
+
+CONSIDERATION = 'consideration'
+EXECUTION = 'execution'
+
+# Removes and returns the due members in one step, so concurrent workers never claim the same deadline
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+def consideration_deadline(date_receipt: datetime) -> datetime:
+    return date_receipt + timedelta(hours=float(Config.CONSIDERATION_REQUEST_TIME))
+
+
+def execution_deadline(date_receipt: datetime) -> datetime:
+    return date_receipt + timedelta(hours=float(Config.REQUEST_EXECUTION_TIME))
+
+
+class DeadlineTimer:
+    """Timer of the request deadlines, asynchronous methods for the API and synchronous ones for the worker
+
+    Errors of Redis in the API are counted and logged, the request is changed anyway.
+    aioredis is imported by the API only, the worker uses the synchronous client.
+    The connections belong to one process, after fork the child process opens its own ones.
+    """
+
+    def __init__(self, url: str, key: str = 'deadlines'):
+        self.url = url
+        self.key = key
+        self.errors = 0
+        self._redis = None
+        self._sync_redis = None
+        self._claim = None
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():  # The connections were inherited from the parent process
+            self._redis = self._sync_redis = self._claim = None
+            self._pid = os.getpid()
+
+    async def _client(self):
+        self._check_pid()
+        if self._redis is None:
+            import aioredis
+            self._redis = await aioredis.create_redis_pool(self.url)
+        return self._redis
+
+    def _error(self, operation: str, alert: str, count: int, error: Exception):
+        self.errors += 1
+        DEADLINE_TIMER_ERRORS.labels(operation).inc()
+        log('deadline_timer_error', operation=operation, alert=alert, requests=count, error=str(error))
+
+    def _sync_client(self):
+        self._check_pid()
+        if self._sync_redis is None:
+            import redis
+            self._sync_redis = redis.Redis.from_url(self.url, decode_responses=True)
+            self._claim = self._sync_redis.register_script(CLAIM_SCRIPT)
+        return self._sync_redis
+
+    async def schedule(self, alert: str, deadlines: dict):
+        """Schedule or reschedule deadlines
+
+        :param alert: CONSIDERATION or EXECUTION
+        :param deadlines: dictionary {request id: datetime of the deadline}
+        """
+        if not deadlines:
+            return
+        from aioredis import RedisError
+        pairs = []
+        for request_id, deadline in deadlines.items():
+            pairs += [deadline.timestamp(), f'{alert}:{request_id}']
+        try:
+            await (await self._client()).zadd(self.key, *pairs)
+        except (RedisError, OSError) as error:
+            self._error('schedule', alert, len(deadlines), error)
+
+    async def cancel(self, alert: str, *request_ids):
+        """Cancel deadlines, unknown ones are ignored
+
+        :param alert: CONSIDERATION or EXECUTION
+        :param request_ids: ids of the requests
+        """
+        if not request_ids:
+            return
+        from aioredis import RedisError
+        try:
+            await (await self._client()).zrem(self.key, *(f'{alert}:{request_id}' for request_id in request_ids))
+        except (RedisError, OSError) as error:
+            self._error('cancel', alert, len(request_ids), error)
+
+    def claim_due(self, limit: int, now: datetime = None) -> dict:
+        """Remove and return the deadlines which have passed
+
+        :param limit: maximum number of deadlines
+        :param now: current time
+        :return: dictionary {alert: [request id, ...]}
+        """
+        self._sync_client()
+        due = {}
+        for member in self._claim(keys=[self.key], args=[(now or datetime.now()).timestamp(), limit]):
+            alert, _, request_id = member.partition(':')
+            due.setdefault(alert, []).append(request_id)
+        return due
+
+    def schedule_sync(self, alert: str, request_ids: list, deadline: datetime):
+        """Schedule deadlines from the worker, e.g. the next notification about a request still overdue
+
+        :param alert: CONSIDERATION or EXECUTION
+        :param request_ids: ids of the requests
+        :param deadline: datetime of the deadlines
+        """
+        if request_ids:
+            self._sync_client().zadd(self.key, {f'{alert}:{request_id}': deadline.timestamp()
+                                                for request_id in request_ids})
+
+    def reconcile(self, alert: str, deadlines: dict) -> int:
+        """Schedule the missing deadlines, the scheduled ones keep their score (e.g. the next notification)
+
+        :param alert: CONSIDERATION or EXECUTION
+        :param deadlines: dictionary {request id: datetime of the deadline}
+        :return: number of the deadlines which were missing
+        """
+        if not deadlines:
+            return 0
+        return self._sync_client().zadd(self.key, {f'{alert}:{request_id}': deadline.timestamp()
+                                                   for request_id, deadline in deadlines.items()}, nx=True)
+
+    async def close(self):
+        if self._redis is not None and self._pid == os.getpid():
+            self._redis.close()
+            await self._redis.wait_closed()
+            self._redis = None
+
+
+deadline_timer = DeadlineTimer(Config.REDIS_URL)
@@ -0,0 +1,39 @@
+import hashlib
+
+
+def make_etag(*parts) -> str:
+    """Build a strong ETag from the parts of a representation
+
+    :param parts: values identifying the representation (ids, versions, role, fields, ...)
+    :return: quoted ETag
+    """
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def request_etag(requests: list, role: str, fields: frozenset = None, *extra) -> str:
+    """Build the ETag of the representation of requests, it changes with the version of any request
+
+    :param requests: documents of the requests with _id and version
+    :param role: role of the user, the representation depends on it
+    :param fields: sparse fieldset, the representation depends on it
+    :param extra: other values of the representation (e.g. the cursor of the next page)
+    :return: quoted ETag
+    """
+    return make_etag(role, ','.join(sorted(fields)) if fields is not None else '*',
+                     *(f"{request['_id']}:{request.get('version', 0)}" for request in requests), *extra)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check the If-None-Match header, with the weak comparison of RFC 7232
+
+    :param if_none_match: value of the header or None
+    :param etag: current ETag
+    :return: True if the client has the current representation
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
@@ -0,0 +1,34 @@
+import csv
+import io
+
+from models.requests import RequestOutAdmin
+
+CSV_FIELDS = list(RequestOutAdmin.__fields__)
+
+
+async def to_ndjson(rows):
+    """Serialize models into newline delimited JSON, one line per model
+
+    :param rows: asynchronous iterable of pydantic models
+    :return: asynchronous generator of str
+    """
+    async for row in rows:
+        yield row.json() + '\n'
+
+
+async def to_csv(rows):
+    """Serialize RequestOutAdmin models into CSV with a header line
+
+    :param rows: asynchronous iterable of RequestOutAdmin
+    :return: asynchronous generator of str
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    async for row in rows:
+        writer.writerow(row.dict())
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # Header of an empty export
+        yield buffer.getvalue()
@@ -0,0 +1,70 @@
+"""Report of the import time of the entry points
+
+    python -m utils.importtime                      # app and celery_app
+    python -m utils.importtime celery_app --top 20 --max-ms 800
+
+Every module is imported in a fresh interpreter with python -X importtime,
+the report shows the total time and the slowest packages including their dependencies.
+"""
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+DEFAULT_MODULES = ['app', 'celery_app']
+
+
+def import_times(module: str) -> list:
+    """Import a module in a fresh interpreter
+
+    :param module: name of the module
+    :return: list of tuples (name, self microseconds, cumulative microseconds, depth) in the import order
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError(f'Failed to import {module}:\n{result.stderr[-2000:]}')
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+
+def packages(entries: list) -> list:
+    """Sum the self time of the modules by top-level package
+
+    :param entries: result of import_times
+    :return: list of tuples (package, microseconds), slowest first
+    """
+    total = defaultdict(int)
+    for name, self_us, _, _ in entries:
+        total[name.split('.')[0]] += self_us
+    return sorted(total.items(), key=lambda item: item[1], reverse=True)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--top', type=int, default=15, help='number of packages in the report')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail if an import takes longer')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in args.modules:
+        entries = import_times(module)
+        total_ms = entries[-1][2] / 1000 if entries else 0.0
+        print(f'{module}: {total_ms:.0f} ms, {len(entries)} modules')
+        for package, microseconds in packages(entries)[:args.top]:
+            print(f'  {package:<30}{microseconds / 1000:>9.1f} ms')
+        if args.max_ms is not None and total_ms > args.max_ms:
+            print(f'{module}: the import takes more than {args.max_ms} ms')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Declarative registry of the MongoDB indexes used by the service
+
+Run ``python -m utils.indexes create`` to create the indexes
+and ``python -m utils.indexes check`` to report missing, unknown and unused ones.
+"""
+import argparse
+import sys
+
+from pymongo import ASCENDING, DESCENDING
+
+INDEXES = {
+    'user': [
+        {'name': 'email_unique', 'keys': [('email', ASCENDING)], 'unique': True},
+        {'name': 'role_date_registration', 'keys': [('role', ASCENDING), ('date_registration', DESCENDING)]},
+    ],
+    'request': [
+        {'name': 'user_id_date_receipt',
+         'keys': [('user_id', ASCENDING), ('date_receipt', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'employee_id_date_receipt',
+         'keys': [('employee_id', ASCENDING), ('date_receipt', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'date_receipt', 'keys': [('date_receipt', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'status_date_receipt', 'keys': [('status', ASCENDING), ('date_receipt', ASCENDING)]},
+        {'name': 'employee_id_status_date_receipt',
+         'keys': [('employee_id', ASCENDING), ('status', ASCENDING), ('date_receipt', ASCENDING)]},
+    ],
+    'notification': [
+        {'name': 'expires_at_ttl', 'keys': [('expires_at', ASCENDING)], 'expireAfterSeconds': 0},
+    ],
+}
+
+
+def _index_options(index: dict) -> dict:
+    """Get create_index keyword arguments of an index from the registry
+
+    :param index: index description from INDEXES
+    :return: dictionary of options (name, unique, ...)
+    """
+    return {key: value for key, value in index.items() if key != 'keys'}
+
+
+def ensure_indexes(database) -> list:
+    """Create the registered indexes, existing indexes are left untouched
+
+    :param database: pymongo Database
+    :return: names of the indexes in the registry
+    """
+    names = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            names.append(database[collection].create_index(index['keys'], **_index_options(index)))
+    return names
+
+
+async def ensure_indexes_async(database) -> list:
+    """Create the registered indexes through the motor client
+
+    :param database: motor AsyncIOMotorDatabase
+    :return: names of the indexes in the registry
+    """
+    names = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            names.append(await database[collection].create_index(index['keys'], **_index_options(index)))
+    return names
+
+
+def check_indexes(database) -> dict:
+    """Compare the indexes of the database with the registry
+
+    :param database: pymongo Database
+    :return: dictionary {collection: {'missing': [...], 'unknown': [...], 'unused': [...]}}
+    """
+    report = {}
+    for collection, indexes in INDEXES.items():
+        existing = {index['name']: index for index in database[collection].list_indexes()}
+        registered = {index['name'] for index in indexes}
+        stats = {stat['name']: stat['accesses']['ops']
+                 for stat in database[collection].aggregate([{'$indexStats': {}}])}
+        report[collection] = {
+            'missing': sorted(registered - set(existing)),
+            'unknown': sorted(name for name in existing if name not in registered and name != '_id_'),
+            'unused': sorted(name for name in existing if name != '_id_' and stats.get(name) == 0),
+        }
+    return report
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Manage the MongoDB indexes of realty-service')
+    parser.add_argument('command', choices=['create', 'check'])
+    args = parser.parse_args(argv)
+
+    from utils.db import db
+    if args.command == 'create':
+        for name in ensure_indexes(db):
+            print(f'Index {name} is ready')
+        return 0
+    failed = False
+    for collection, result in check_indexes(db).items():
+        for problem, names in result.items():
+            for name in names:
+                print(f'{collection}: {problem} index {name}')
+        failed = failed or bool(result['missing'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
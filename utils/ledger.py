@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+
+def _key(alert: str, request: dict) -> str:
+    return f"{alert}:{request['_id']}"
+
+
+def filter_not_notified(collection, alert: str, requests: list) -> list:
+    """Keep the requests without an unexpired notification about the alert, checked with one query
+
+    :param collection: pymongo Collection of the ledger
+    :param alert: type of the notification
+    :param requests: dictionaries with _id
+    :return: requests to notify about
+    """
+    if not requests:
+        return []
+    notified = {entry['_id'] for entry in collection.find(
+        {'_id': {'$in': [_key(alert, request) for request in requests]}, 'expires_at': {'$gt': datetime.utcnow()}},
+        {'_id': 1})}
+    return [request for request in requests if _key(alert, request) not in notified]
+
+
+def record_notified(collection, alert: str, requests: list, interval_hours: float):
+    """Remember the notifications until the next one is allowed, MongoDB removes expired entries (TTL index)
+
+    :param collection: pymongo Collection of the ledger
+    :param alert: type of the notification
+    :param requests: dictionaries with _id
+    :param interval_hours: time before the requests can be notified about again
+    """
+    if not requests:
+        return
+    now = datetime.utcnow()
+    expires_at = now + timedelta(hours=interval_hours)
+    collection.bulk_write([UpdateOne({'_id': _key(alert, request)},
+                                     {'$set': {'sent_at': now, 'expires_at': expires_at}}, upsert=True)
+                           for request in requests], ordered=False)
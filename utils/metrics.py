@@ -0,0 +1,187 @@
+"""Prometheus metrics of the API, MongoDB commands and celery tasks
+
+The metrics of a process are kept in its default registry. With several processes (uvicorn workers,
+prefork celery workers) set the prometheus_multiproc_dir environment variable to a shared empty directory,
+the values of all processes are then aggregated by metrics_registry.
+"""
+import os
+import time
+from datetime import datetime
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess
+from pymongo import monitoring
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests by route, method and status code',
+                        ['method', 'route', 'status'])
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Latency of HTTP requests by route',
+                                  ['method', 'route'])
+MONGODB_COMMAND_DURATION = Histogram('mongodb_command_duration_seconds',
+                                     'Latency of MongoDB commands by collection and command',
+                                     ['collection', 'command'],
+                                     buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+MONGODB_COMMAND_FAILURES = Counter('mongodb_command_failures_total',
+                                   'Failed MongoDB commands by collection and command', ['collection', 'command'])
+CELERY_TASK_DURATION = Histogram('celery_task_duration_seconds', 'Runtime of celery tasks', ['task'],
+                                 buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120))
+CELERY_TASK_QUEUE_WAIT = Histogram('celery_task_queue_wait_seconds',
+                                   'Time between the publication (or the eta) and the start of celery tasks', ['task'],
+                                   buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+CELERY_TASK_FAILURES = Counter('celery_task_failures_total', 'Failed celery tasks, raised or handled errors', ['task'])
+PROCESS_POOL_CALLS = Counter('process_pool_calls_total',
+                             'Calls of the process pools by pool and result (completed, failed, rejected)',
+                             ['pool', 'result'])
+PROCESS_POOL_PENDING = Gauge('process_pool_pending', 'Calls running or waiting in the process pools', ['pool'],
+                             multiprocess_mode='livesum')
+# The hit ratio of a cache is rate(cache_lookups_total{result="hit"}) / rate(cache_lookups_total)
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Lookups of the in-process caches by cache and result (hit, miss)',
+                        ['cache', 'result'])
+# The hit ratio of the cache is rate(request_cache_lookups_total{result="hit"}) / rate(request_cache_lookups_total)
+REQUEST_CACHE_LOOKUPS = Counter('request_cache_lookups_total', 'Lookups of the request cache by result (hit, miss)',
+                                ['result'])
+REQUEST_CACHE_ERRORS = Counter('request_cache_errors_total', 'Redis errors of the request cache, treated as misses',
+                               ['operation'])
+DEADLINE_TIMER_ERRORS = Counter('deadline_timer_errors_total',
+                                'Redis errors of the deadline timer in the API, the deadlines are reconciled later',
+                                ['operation'])
+
+# Name of the collection of the commands without one (ismaster, endSessions, ...)
+NO_COLLECTION = ''
+# Route of the requests not matching any route, keeps the cardinality of the route label bounded
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+def metrics_registry():
+    """Get the registry to expose, the aggregate of all processes in the multiprocess mode
+
+    :return: prometheus_client CollectorRegistry
+    """
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def route_name(routes: list, scope: dict) -> str:
+    """Get the path template of the route handling a request
+
+    :param routes: routes of the application
+    :param scope: ASGI scope of the request
+    :return: path template as /requests/{request_id}
+    """
+    from starlette.routing import Match  # Not imported with the module, the celery worker doesn't need starlette
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting the HTTP requests and measuring their latency by route"""
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_name(self.routes, scope)
+            HTTP_REQUEST_DURATION.labels(scope['method'], route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(scope['method'], route, str(status_code)).inc()
+
+
+def command_collection(command_name: str, command: dict) -> str:
+    """Get the collection of a MongoDB command
+
+    :param command_name: name of the command (find, insert, getMore, ...)
+    :param command: the command document
+    :return: name of the collection or NO_COLLECTION
+    """
+    collection = command.get('collection') if command_name == 'getMore' else command.get(command_name)
+    return collection if isinstance(collection, str) else NO_COLLECTION
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo command listener measuring the latency of the commands by collection and command"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        self._collections[(event.connection_id, event.request_id)] = command_collection(event.command_name,
+                                                                                        event.command)
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), NO_COLLECTION)
+        MONGODB_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), NO_COLLECTION)
+        MONGODB_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGODB_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+
+# Listener of the MongoDB clients in utils.db
+mongo_command_metrics = MongoCommandMetrics()
+
+# Start time of the running celery tasks by task id
+_task_started = {}
+
+
+def task_published(headers: dict):
+    """Add the publication time to the headers of a task message"""
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
+def task_started(task, task_id: str):
+    """Measure the queue wait of a task and start measuring its runtime
+
+    :param task: celery Task
+    :param task_id: id of the task
+    """
+    _task_started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is None:
+        return
+    eta = getattr(task.request, 'eta', None)
+    if eta:
+        try:  # A task with an eta (or a countdown) waits for the eta on purpose
+            published_at = max(published_at, datetime.fromisoformat(eta).timestamp())
+        except (TypeError, ValueError):
+            pass
+    CELERY_TASK_QUEUE_WAIT.labels(task.name).observe(max(0.0, time.time() - published_at))
+
+
+def task_finished(task, task_id: str):
+    """Measure the runtime of a task
+
+    :param task: celery Task
+    :param task_id: id of the task
+    """
+    start = _task_started.pop(task_id, None)
+    if start is not None:
+        CELERY_TASK_DURATION.labels(task.name).observe(time.perf_counter() - start)
+
+
+def task_failed(task_name: str):
+    """Count a failed task, also for errors handled by the task itself
+
+    :param task_name: name of the celery task
+    """
+    CELERY_TASK_FAILURES.labels(task_name).inc()
@@ -0,0 +1,50 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from pymongo import ASCENDING
+from starlette import status
+
+# Order of the pages, must match the keyset filter below and the indexes in utils.indexes
+SORT_REQUESTS = [('date_receipt', ASCENDING), ('_id', ASCENDING)]
+
+
+def encode_cursor(date_receipt: datetime, request_id: str) -> str:
+    """Encode the position after a request into an opaque cursor
+
+    :param date_receipt: date receipt of the last request on the page
+    :param request_id: id of the last request on the page
+    :return: urlsafe string
+    """
+    data = json.dumps({'d': date_receipt.isoformat(), 'i': str(request_id)})
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor created by encode_cursor
+
+    :param cursor: urlsafe string
+    :return: tuple (date_receipt, ObjectId)
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(data['d']), ObjectId(data['i'])
+    except (binascii.Error, ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+
+def keyset_filter(cursor: str) -> dict:
+    """Get a filter selecting the requests after the cursor in SORT_REQUESTS order
+
+    :param cursor: urlsafe string from encode_cursor
+    :return: MongoDB filter
+    """
+    date_receipt, request_id = decode_cursor(cursor)
+    return {'$or': [
+        {'date_receipt': {'$gt': date_receipt}},
+        {'date_receipt': date_receipt, '_id': {'$gt': request_id}}
+    ]}
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+from starlette import status
+
+from utils.metrics import PROCESS_POOL_CALLS, PROCESS_POOL_PENDING
+
+
+class BoundedProcessPool:
+    """Process pool for CPU bound functions with a bounded number of pending calls
+
+    When the pool is saturated the call is rejected with 429 instead of queueing
+    behind other calls. The processes are started on the first call,
+    after fork the child process starts its own ones. When a process of the pool dies
+    (e.g. killed for lack of memory) the pool is replaced on the next call.
+    The counters of a named pool are also exported as Prometheus metrics (see utils.metrics).
+    """
+
+    def __init__(self, workers: int, max_pending: int, name: str = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+        self._executor = None
+        self._pid = os.getpid()
+        self._calls = {result: PROCESS_POOL_CALLS.labels(name, result)
+                       for result in ('completed', 'failed', 'rejected')} if name else None
+        self._pending = PROCESS_POOL_PENDING.labels(name) if name else None
+
+    def _count(self, result: str):
+        setattr(self, result, getattr(self, result) + 1)
+        if self._calls is not None:
+            self._calls[result].inc()
+
+    def _add_pending(self, value: int):
+        self.pending += value
+        if self._pending is not None:
+            self._pending.inc(value)
+
+    async def run(self, func, *args):
+        """Run a function in the pool
+
+        :param func: picklable function
+        :param args: arguments of the function
+        :return: result of the function
+        """
+        if self.pending >= self.max_pending:
+            self._count('rejected')
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='Server is busy, try again later',
+                                headers={'Retry-After': '1'})
+        self._add_pending(1)
+        start = time.perf_counter()
+        executor = None
+        try:
+            if self.workers <= 0:  # Inline mode, e.g. for debugging
+                result = func(*args)
+            else:
+                executor = self._get_executor()
+                result = await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            self._count('failed')
+            if self._executor is executor:  # The broken executor has already terminated its processes
+                self._executor = None
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail='Server is busy, try again later', headers={'Retry-After': '1'})
+        except BaseException:  # Including the cancellation of the call
+            self._count('failed')
+            raise
+        finally:
+            self._add_pending(-1)
+            self.busy_seconds += time.perf_counter() - start
+        self._count('completed')
+        return result
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._pid != os.getpid():  # The executor was inherited from the parent process
+            self._executor = None
+            self._pid = os.getpid()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def stats(self) -> dict:
+        """Get the counters of the pool
+
+        :return: dictionary with workers, pending, completed, failed, rejected and busy_seconds
+        """
+        return {'workers': self.workers, 'pending': self.pending, 'completed': self.completed,
+                'failed': self.failed, 'rejected': self.rejected, 'busy_seconds': self.busy_seconds}
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+            self._executor = None
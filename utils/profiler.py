@@ -0,0 +1,199 @@
+"""Profiler of the MongoDB commands issued by every HTTP request and celery task
+
+Enabled with PROFILER. Every command is attributed to the operation running in the current context
+(the commands of motor run in a copy of the caller's context, see utils.db), commands slower than
+SLOW_QUERY_MS and operations issuing more than QUERY_BUDGET commands are logged as JSON lines,
+the last operations are kept for the /debug/profiler endpoint.
+"""
+import contextvars
+import json
+import time
+from collections import Counter, deque
+
+from pymongo import monitoring
+
+from config import Config
+from utils.metrics import command_collection, route_name
+
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+# The field holding the filter of a command
+FILTER_FIELDS = {'find': 'filter', 'count': 'query', 'distinct': 'query', 'findAndModify': 'query',
+                 'aggregate': 'pipeline'}
+# The field holding the statements of a write command and the filter of a statement
+STATEMENT_FIELDS = {'update': ('updates', 'q'), 'delete': ('deletes', 'q')}
+
+# Summaries of the last operations and the last slow commands, newest last
+recent_profiles = deque(maxlen=Config.PROFILER_HISTORY)
+slow_queries = deque(maxlen=Config.PROFILER_HISTORY)
+
+
+def log(event: str, **fields):
+    """Print a structured log line
+
+    :param event: name of the event
+    :param fields: fields of the event
+    """
+    print(json.dumps(dict(event=event, **fields), default=str))
+
+
+def query_shape(value):
+    """Replace the values of a filter with '?', the shape is the same for every value
+
+    :param value: filter, pipeline or value
+    :return: the shape
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and any(isinstance(item, (dict, list, tuple)) for item in value):
+        return [query_shape(item) for item in value]
+    return '?'
+
+
+def command_shape(command_name: str, command: dict):
+    """Get the shape of the filter of a MongoDB command
+
+    :param command_name: name of the command (find, update, ...)
+    :param command: the command document
+    :return: the shape or None for commands without a filter
+    """
+    if command_name in FILTER_FIELDS:
+        return query_shape(command.get(FILTER_FIELDS[command_name], {}))
+    if command_name in STATEMENT_FIELDS:
+        field, key = STATEMENT_FIELDS[command_name]
+        statements = command.get(field) or []
+        return query_shape(statements[0].get(key, {})) if statements else None
+    return None
+
+
+class Profile:
+    """MongoDB commands of one HTTP request or celery task"""
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.commands = []
+        self._start = time.perf_counter()
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def summary(self) -> dict:
+        """Get the summary of the operation
+
+        :return: dictionary with the commands, the number of queries and the repeated filter shapes
+        """
+        shapes = Counter((command['collection'], command['command'], json.dumps(command['shape'], sort_keys=True))
+                         for command in self.commands)
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': self.duration_ms,
+            'queries': len(self.commands),
+            'mongo_ms': sum(command['duration_ms'] for command in self.commands),
+            'over_budget': len(self.commands) > Config.QUERY_BUDGET,
+            'repeated': [{'collection': collection, 'command': command, 'shape': json.loads(shape), 'count': count}
+                         for (collection, command, shape), count in shapes.items() if count > 1],
+            'commands': self.commands,
+        }
+
+
+class MongoProfiler(monitoring.CommandListener):
+    """pymongo command listener recording the commands in the profile of the current context"""
+
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            self._started[(event.connection_id, event.request_id)] = (
+                profile, command_collection(event.command_name, event.command),
+                command_shape(event.command_name, event.command))
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def _record(self, event, failed: bool):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        profile, collection, shape = started
+        command = {'collection': collection, 'command': event.command_name, 'shape': shape,
+                   'duration_ms': event.duration_micros / 1000, 'failed': failed}
+        profile.commands.append(command)
+        if command['duration_ms'] >= Config.SLOW_QUERY_MS:
+            slow_query = dict(command, operation=profile.name)
+            slow_queries.append(slow_query)
+            log('slow_query', **slow_query)
+
+
+# Listener of the MongoDB clients in utils.db
+mongo_profiler = MongoProfiler()
+
+
+def start_profile(kind: str, name: str) -> tuple:
+    """Start profiling an operation in the current context
+
+    :param kind: http or task
+    :param name: name of the operation (route or task name)
+    :return: tuple (Profile, token for finish_profile)
+    """
+    profile = Profile(kind, name)
+    return profile, current_profile.set(profile)
+
+
+def finish_profile(profile: Profile, token) -> dict:
+    """Stop profiling an operation, log it if it exceeds the query budget
+
+    :param profile: Profile from start_profile
+    :param token: token from start_profile
+    :return: summary of the operation
+    """
+    current_profile.reset(token)
+    profile.finish()
+    summary = profile.summary()
+    recent_profiles.append(summary)
+    if summary['over_budget']:
+        log('query_budget_exceeded', kind=profile.kind, operation=profile.name, queries=summary['queries'],
+            budget=Config.QUERY_BUDGET, mongo_ms=summary['mongo_ms'], repeated=summary['repeated'])
+    return summary
+
+
+class ProfilerMiddleware:
+    """ASGI middleware profiling the MongoDB commands of every HTTP request when PROFILER is on"""
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not Config.PROFILER:
+            await self.app(scope, receive, send)
+            return
+        profile, token = start_profile('http', f"{scope['method']} {route_name(self.routes, scope)}")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            finish_profile(profile, token)
+
+
+# Profiles of the running celery tasks by task id
+_task_profiles = {}
+
+
+def task_started(task_id: str, task_name: str):
+    if Config.PROFILER:
+        _task_profiles[task_id] = start_profile('task', task_name)
+
+
+def task_finished(task_id: str):
+    started = _task_profiles.pop(task_id, None)
+    if started is not None:
+        finish_profile(*started)
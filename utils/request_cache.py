@@ -0,0 +1,116 @@
+import asyncio
+import os
+
+import aioredis
+import bson
+
+from config import Config
+from utils.metrics import REQUEST_CACHE_ERRORS, REQUEST_CACHE_LOOKUPS
+
+# Writes a document unless the cached one has the same or a newer version: a reader putting back the document
+# it read before a change can't replace the document written by the change
+SET_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'version')
+if current and tonumber(current) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HMSET', KEYS[1], 'version', ARGV[1], 'document', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class RequestCache:
+    """Read-through cache of request documents in Redis, versioned by the version field of the documents
+
+    The changes of a request write the new document instead of deleting the cached one.
+    Errors of Redis are counted and treated as misses, so the API keeps working on MongoDB alone.
+    The counters are also exported as Prometheus metrics (see utils.metrics).
+    The connections belong to one process, after fork the child process opens its own ones.
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str = 'request:doc:'):
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._redis = None
+        self._pid = os.getpid()
+
+    async def _client(self):
+        if self._pid != os.getpid():  # The pool was inherited from the parent process
+            self._redis = None
+            self._pid = os.getpid()
+        if self._redis is None:
+            self._redis = await aioredis.create_redis_pool(self.url)
+        return self._redis
+
+    async def get(self, request_id: str):
+        """Get a document of a request
+
+        :param request_id: id request
+        :return: the document or None if it is not cached
+        """
+        try:
+            data = await (await self._client()).hget(self.prefix + request_id, 'document')
+        except (aioredis.RedisError, OSError):
+            self._error('get')
+            data = None
+        if data is None:
+            self.misses += 1
+            REQUEST_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+        self.hits += 1
+        REQUEST_CACHE_LOOKUPS.labels('hit').inc()
+        return bson.decode(data)
+
+    async def set(self, *requests: dict):
+        """Cache documents of requests, the cached documents with the same or a newer version are kept
+
+        :param requests: the documents with _id and version
+        """
+        if not requests:
+            return
+        try:
+            redis = await self._client()
+            await asyncio.gather(*(redis.eval(SET_SCRIPT, keys=[self.prefix + str(request['_id'])],
+                                              args=[request.get('version', 0), bson.encode(request), self.ttl])
+                                   for request in requests))
+        except (aioredis.RedisError, OSError):
+            self._error('set')
+
+    async def invalidate(self, *request_ids: str):
+        """Remove documents of requests
+
+        :param request_ids: ids of the requests
+        """
+        if not request_ids:
+            return
+        try:
+            await (await self._client()).delete(*(self.prefix + str(request_id) for request_id in request_ids))
+        except (aioredis.RedisError, OSError):
+            self._error('invalidate')
+
+    def _error(self, operation: str):
+        self.errors += 1
+        REQUEST_CACHE_ERRORS.labels(operation).inc()
+
+    def stats(self) -> dict:
+        """Get the counters of the cache
+
+        :return: dictionary with hits, misses, errors and hit_ratio
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    async def close(self):
+        if self._redis is not None and self._pid == os.getpid():
+            self._redis.close()
+            await self._redis.wait_closed()
+            self._redis = None
+
+
+request_cache = RequestCache(Config.REDIS_URL, Config.REQUEST_CACHE_TTL)
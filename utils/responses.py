@@ -0,0 +1,52 @@
+import orjson
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+from config import Config
+
+
+def _default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response encoded by orjson, pydantic models are serialized without validation"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_default)
+
+
+def build_model(model, values: dict):
+    """Create a pydantic model from data written by the service itself
+
+    :param model: pydantic model class
+    :param values: values of all fields of the model
+    :return: the model, not validated when FAST_RESPONSES is on
+    """
+    if Config.FAST_RESPONSES:
+        return model.construct(_fields_set=set(values), **values)
+    return model(**values)
+
+
+def respond(content, status_code: int = 200, headers: dict = None):
+    """Return the content of an endpoint through the fast path when FAST_RESPONSES is on
+
+    The fast path skips the validation against response_model and jsonable_encoder,
+    it must only be used for data built by the service itself.
+
+    :param content: data returned by an endpoint
+    :param status_code: status code of the response
+    :param headers: headers of the response
+    :return: ORJSONResponse, JSONResponse with the headers or the content unchanged
+    """
+    if Config.FAST_RESPONSES:
+        return ORJSONResponse(content, status_code=status_code, headers=headers)
+    if headers:
+        return JSONResponse(jsonable_encoder(content), status_code=status_code, headers=headers)
+    return content
@@ -0,0 +1,108 @@
+import os
+import queue
+import smtplib
+import time
+
+
+class SMTPConnection:
+    """Authenticated SMTP connection with its usage counters"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """Pool of authenticated SMTP connections reused between messages
+
+    A connection is checked with NOOP when it has been idle for more than healthcheck_interval seconds,
+    reopened after a failure and closed after max_messages messages.
+    The pool belongs to one process, after fork the child process creates its own connections.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str, size: int = 2, max_messages: int = 100,
+                 healthcheck_interval: float = 30, factory=smtplib.SMTP):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.healthcheck_interval = healthcheck_interval
+        self.factory = factory
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _open(self) -> SMTPConnection:
+        smtp = self.factory(self.host, self.port)
+        smtp.starttls()
+        smtp.login(self.user, self.password)
+        return SMTPConnection(smtp)
+
+    @staticmethod
+    def _close(connection: SMTPConnection):
+        try:
+            connection.smtp.quit()
+        except OSError:  # smtplib.SMTPException is a subclass of OSError
+            connection.smtp.close()
+
+    def _is_alive(self, connection: SMTPConnection) -> bool:
+        if time.monotonic() - connection.last_used < self.healthcheck_interval:
+            return True
+        try:
+            return connection.smtp.noop()[0] == 250
+        except OSError:  # smtplib.SMTPException is a subclass of OSError
+            return False
+
+    def _acquire(self) -> SMTPConnection:
+        if self._pid != os.getpid():  # The pool was inherited from the parent process
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self._open()
+            if self._is_alive(connection):
+                return connection
+            self._close(connection)
+
+    def _release(self, connection: SMTPConnection):
+        connection.last_used = time.monotonic()
+        if connection.messages >= self.max_messages or self._idle.qsize() >= self.size:
+            self._close(connection)
+        else:
+            self._idle.put(connection)
+
+    def sendmail(self, from_addr: str, to_addr: str, message: str):
+        """Send a message, a broken connection is replaced and the message is sent again once
+
+        :param from_addr: sender's email address
+        :param to_addr: recipient's email address
+        :param message: the message as a string
+        """
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                connection.smtp.sendmail(from_addr, to_addr, message)
+            except smtplib.SMTPServerDisconnected:
+                self._close(connection)
+                if attempt:
+                    raise
+                continue
+            except smtplib.SMTPException:  # The message is rejected, the connection is still usable
+                self._release(connection)
+                raise
+            except OSError:
+                self._close(connection)
+                if attempt:
+                    raise
+                continue
+            connection.messages += 1
+            self._release(connection)
+            return
+
+    def close(self):
+        while not self._idle.empty():
+            self._close(self._idle.get_nowait())
@@ -0,0 +1,20 @@
+from uuid import uuid4
+
+from utils import tracing
+
+
+def send_email(email: str, title: str, description: str):
+    """Queue the send_email task, celery_app is imported on the first call, not with the API
+
+    :param email: recipient's email address as name@email.com
+    :param title: message subject
+    :param description: the text of the letter
+    :return: celery AsyncResult
+    """
+    from celery_app import send_email as send_email_task
+    task_id = str(uuid4())
+    try:
+        return send_email_task.apply_async((email,), {'title': title, 'description': description}, task_id=task_id)
+    except BaseException as error:  # after_task_publish is not sent, the span of the publication is ended here
+        tracing.task_publish_failed(task_id, error)
+        raise
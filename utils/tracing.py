@@ -0,0 +1,347 @@
+"""Tracing of the HTTP requests, MongoDB commands and celery tasks
+
+Enabled with TRACING. The spans are linked with W3C trace context: the traceparent header of
+HTTP requests is continued and the celery messages carry a traceparent header, so a task span is a child
+of the request publishing it. Finished spans are written as JSON lines to TRACING_FILE
+or sent in batches to an OTLP/HTTP JSON endpoint (TRACING_EXPORTER=otlp, TRACING_OTLP_URL).
+"""
+import contextvars
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+from config import Config
+from utils.metrics import command_collection, route_name
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+# Span kinds, values of the OTLP protocol
+INTERNAL, SERVER, CLIENT, PRODUCER, CONSUMER = 1, 2, 3, 4, 5
+
+
+class Span:
+    """Timed operation of a trace"""
+
+    def __init__(self, name: str, kind: int = INTERNAL, trace_id: str = None, parent_id: str = None,
+                 attributes: dict = None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+
+    def set_error(self, error):
+        self.error = f'{type(error).__name__}: {error}' if isinstance(error, BaseException) else str(error)
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            export(self)
+
+    def to_dict(self) -> dict:
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'kind': self.kind, 'start_time': self.start_time, 'end_time': self.end_time,
+                'duration_ms': (self.end_time - self.start_time) / 1e6, 'attributes': self.attributes,
+                'error': self.error, 'service': Config.TRACING_SERVICE_NAME}
+
+
+def format_traceparent(span: Span) -> str:
+    """Get the W3C traceparent of a span"""
+    return f'00-{span.trace_id}-{span.span_id}-01'
+
+
+def parse_traceparent(traceparent: str) -> tuple:
+    """Parse a W3C traceparent
+
+    :param traceparent: value of the header
+    :return: tuple (trace_id, parent span_id) or (None, None) if the value is invalid
+    """
+    parts = (traceparent or '').strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None, None
+    return parts[1], parts[2]
+
+
+def start_span(name: str, kind: int = INTERNAL, attributes: dict = None, traceparent: str = None) -> Span:
+    """Create a child of the current span, or of the remote parent of traceparent, or a new trace
+
+    :param name: name of the operation
+    :param kind: INTERNAL, SERVER, CLIENT, PRODUCER or CONSUMER
+    :param attributes: attributes of the span
+    :param traceparent: W3C traceparent of a remote parent
+    :return: the Span, it must be ended with Span.end
+    """
+    trace_id, parent_id = parse_traceparent(traceparent) if traceparent else (None, None)
+    parent = current_span.get()
+    if trace_id is None and parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    return Span(name, kind, trace_id, parent_id, attributes)
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, attributes: dict = None, traceparent: str = None):
+    """Run a block in a span which is the current span inside the block, nothing is traced without TRACING
+
+    :return: the Span or None
+    """
+    if not Config.TRACING:
+        yield None
+        return
+    new_span = start_span(name, kind, attributes, traceparent)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        new_span.set_error(error)
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.end()
+
+
+class BatchExporter:
+    """Exports the spans in batches from a background thread, the event loop never waits for the export
+
+    The thread belongs to one process, after fork the child process starts its own thread.
+    Spans are dropped when the export fails or the queue is full.
+    """
+
+    def __init__(self, batch_size: int = 256, interval: float = 1, max_queue: int = 10000):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue = None
+        self._pid = None
+
+    def export(self, finished: Span):
+        if self._pid != os.getpid():  # The exporter was inherited from the parent process
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            threading.Thread(target=self._run, name=type(self).__name__, daemon=True).start()
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self.send(batch)
+
+    def send(self, batch: list):
+        raise NotImplementedError
+
+
+class FileExporter(BatchExporter):
+    """Appends the spans as JSON lines to a file"""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def send(self, batch: list):
+        lines = ''.join(json.dumps(finished.to_dict(), default=str) + '\n' for finished in batch)
+        try:
+            with open(self.path, 'a') as file:
+                file.write(lines)
+        except OSError as error:
+            self.dropped += len(batch)
+            print(f'Error: failed to export {len(batch)} spans: {error}')
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(finished: Span) -> dict:
+    """Convert a span to the OTLP JSON encoding"""
+    result = {'traceId': finished.trace_id, 'spanId': finished.span_id, 'name': finished.name,
+              'kind': finished.kind, 'startTimeUnixNano': str(finished.start_time),
+              'endTimeUnixNano': str(finished.end_time),
+              'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in finished.attributes.items()],
+              'status': {'code': 2, 'message': finished.error} if finished.error else {'code': 1}}
+    if finished.parent_id:
+        result['parentSpanId'] = finished.parent_id
+    return result
+
+
+class OTLPExporter(BatchExporter):
+    """Sends the spans in batches to an OTLP/HTTP JSON endpoint"""
+
+    def __init__(self, url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+
+    def send(self, batch: list):
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name',
+                                         'value': otlp_value(Config.TRACING_SERVICE_NAME)}]},
+            'instrumentationLibrarySpans': [{'instrumentationLibrary': {'name': 'realty-service'},
+                                             'spans': [otlp_span(finished) for finished in batch]}]}]}
+        request = urllib.request.Request(self.url, data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(request, timeout=5).close()
+        except OSError as error:  # urllib.error.URLError is a subclass of OSError
+            self.dropped += len(batch)
+            print(f'Error: failed to export {len(batch)} spans: {error}')
+
+
+_exporter = None
+
+
+def export(finished: Span):
+    global _exporter
+    if _exporter is None:
+        if Config.TRACING_EXPORTER == 'otlp':
+            _exporter = OTLPExporter(Config.TRACING_OTLP_URL)
+        else:
+            _exporter = FileExporter(Config.TRACING_FILE)
+    _exporter.export(finished)
+
+
+class TracingMiddleware:
+    """ASGI middleware running every HTTP request in a server span when TRACING is on"""
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not Config.TRACING:
+            await self.app(scope, receive, send)
+            return
+        route = route_name(self.routes, scope)
+        headers = dict(scope['headers'])
+        traceparent = headers.get(b'traceparent', b'').decode('latin-1') or None
+
+        with span(f"{scope['method']} {route}", SERVER, {'http.method': scope['method'], 'http.route': route,
+                                                          'http.target': scope['path']}, traceparent) as server:
+            async def send_wrapper(message):
+                if message['type'] == 'http.response.start':
+                    server.attributes['http.status_code'] = message['status']
+                    if message['status'] >= 500:
+                        server.error = f"HTTP {message['status']}"
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+
+
+class MongoTracer(monitoring.CommandListener):
+    """pymongo command listener creating a client span for every command issued inside a trace"""
+
+    def __init__(self):
+        self._spans = {}
+
+    def started(self, event):
+        if not Config.TRACING or current_span.get() is None:
+            return
+        self._spans[(event.connection_id, event.request_id)] = start_span(
+            f'mongodb.{event.command_name}', CLIENT,
+            {'db.system': 'mongodb', 'db.name': event.database_name, 'db.operation': event.command_name,
+             'db.mongodb.collection': command_collection(event.command_name, event.command)})
+
+    def succeeded(self, event):
+        command_span = self._spans.pop((event.connection_id, event.request_id), None)
+        if command_span is not None:
+            command_span.end()
+
+    def failed(self, event):
+        command_span = self._spans.pop((event.connection_id, event.request_id), None)
+        if command_span is not None:
+            command_span.set_error(event.failure.get('errmsg', event.failure))
+            command_span.end()
+
+
+# Listener of the MongoDB clients in utils.db
+mongo_tracer = MongoTracer()
+
+# Publish spans by task id, oldest first, and task spans by task id with the tokens of the current span
+_publish_spans = OrderedDict()
+_task_spans = {}
+# A publish failing before after_task_publish leaves its span behind, the oldest spans are ended beyond this number
+MAX_PUBLISH_SPANS = 1000
+
+
+def task_publishing(headers: dict):
+    """Start the producer span of a task message and put its context into the headers"""
+    if not Config.TRACING or headers is None:
+        return
+    publish_span = start_span(f"celery.publish {headers.get('task')}", PRODUCER,
+                              {'celery.task_name': headers.get('task'), 'celery.task_id': headers.get('id')})
+    headers['traceparent'] = format_traceparent(publish_span)
+    _publish_spans[headers.get('id')] = publish_span
+    while len(_publish_spans) > MAX_PUBLISH_SPANS:
+        _, lost_span = _publish_spans.popitem(last=False)
+        lost_span.set_error('The publication was not confirmed')
+        lost_span.end()
+
+
+def task_publish_failed(task_id: str, error):
+    """End the producer span of a task message whose publication raised"""
+    publish_span = _publish_spans.pop(task_id, None)
+    if publish_span is not None:
+        publish_span.set_error(error)
+        publish_span.end()
+
+
+def task_published(headers: dict):
+    """End the producer span of a task message"""
+    publish_span = _publish_spans.pop((headers or {}).get('id'), None)
+    if publish_span is not None:
+        publish_span.end()
+
+
+def task_started(task, task_id: str):
+    """Start the consumer span of a task, a child of the span publishing it"""
+    if not Config.TRACING:
+        return
+    task_span = start_span(f'celery.run {task.name}', CONSUMER, {'celery.task_name': task.name,
+                                                                'celery.task_id': task_id},
+                           getattr(task.request, 'traceparent', None))
+    _task_spans[task_id] = (task_span, current_span.set(task_span))
+
+
+def task_failed(task_id: str, error):
+    started = _task_spans.get(task_id)
+    if started is not None:
+        started[0].set_error(error)
+
+
+def task_finished(task_id: str, state: str = None):
+    started = _task_spans.pop(task_id, None)
+    if started is not None:
+        task_span, token = started
+        if state:
+            task_span.attributes['celery.state'] = state
+        current_span.reset(token)
+        task_span.end()